@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import UserInfo, Schedule, Intake
+from .models import UserInfo, Schedule, Intake, OutboxMessage, DispatcherTick
 
 
 class UserInfoAdmin(admin.ModelAdmin):
@@ -55,6 +55,40 @@ class IntakeAdmin(admin.ModelAdmin):
     search_fields = ['user_info']
 
 
+class OutboxMessageAdmin(admin.ModelAdmin):
+    list_display = ('user_info',
+                    'scheduled_time',
+                    'expected_amount',
+                    'status',
+                    'attempts',
+                    'next_attempt_time',
+                    'last_error',
+                    )
+    list_filter = ['status',
+                   'scheduled_time',
+                   'next_attempt_time',
+                   ]
+    search_fields = ['user_info']
+
+
+class DispatcherTickAdmin(admin.ModelAdmin):
+    list_display = ('started_time',
+                    'status',
+                    'duration',
+                    'due',
+                    'sent',
+                    'failed',
+                    'skipped',
+                    'backlog',
+                    'max_lag',
+                    )
+    list_filter = ['status',
+                   'started_time',
+                   ]
+
+
 admin.site.register(UserInfo, UserInfoAdmin)
 admin.site.register(Schedule, ScheduleAdmin)
 admin.site.register(Intake, IntakeAdmin)
+admin.site.register(OutboxMessage, OutboxMessageAdmin)
+admin.site.register(DispatcherTick, DispatcherTickAdmin)
@@ -1,10 +1,46 @@
 """A method called by crontab."""
-from .models import Schedule
-from .notification import send_notification
+import logging
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from .dispatcher import chunked
+from .metrics import TickStats, purge_ticks
+from .models import DispatcherLock, DispatcherTick, Schedule, UserInfo
+from .notification import check_token_status
+from .outbox import backlog, drain_outbox, enqueue_due_schedules, purge_outbox, worker_name
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Case, F, Q, Value, When
 from django.utils import timezone
 
+logger = logging.getLogger(__name__)
+
+TICK_LOCK = 'update_notification'
+START_LOCK = 'start_tick'
+
+
+def acquire_tick_lock(holder, now, seconds):
+    """Take the tick lock for holder for the next seconds, return False if another tick holds it.
+
+    The lock is a DispatcherLock row taken with a compare-and-set UPDATE,
+    so it works across processes and hosts. A lock left by a crashed tick
+    expires on its own.
+    """
+    DispatcherLock.objects.get_or_create(name=TICK_LOCK)
+    return bool(DispatcherLock.objects.filter(Q(lease_until__isnull=True) | Q(lease_until__lt=now), name=TICK_LOCK)
+                .update(holder=holder, lease_until=now + timezone.timedelta(seconds=seconds)))
+
 
-def update_notification():
+def release_tick_lock(holder):
+    """Give the tick lock back if holder still has it."""
+    DispatcherLock.objects.filter(name=TICK_LOCK, holder=holder).update(holder='', lease_until=None)
+
+
+def update_notification(clock=None, tick_id=None):
     """Cron job for sending notification via line.
 
     Send notification to the user and update their status.
@@ -12,26 +48,145 @@ def update_notification():
     if it's the time to send notification. After the last notification
     in a user's schedule is sent, the time in the schedule will be
     added by 24 hours.
+
+    Due schedules are copied into the durable outbox first, then the
+    outbox is drained: notifications are sent concurrently and a failed
+    send is retried by a later tick with exponential backoff instead of
+    being lost (see aquaholic.outbox).
+
+    Enqueueing, the purges and the rollover are not lease-safe, so only
+    one tick at a time does them, under the tick lock. A tick that finds
+    the lock held leaves them to the tick holding it. The outbox is drained
+    outside the lock: every message is leased first, so several ticks and
+    dispatchers can drain it at once. Sending stops after
+    settings.NOTIFICATION_TICK_BUDGET seconds and what is left waits for
+    the next tick, so a slow tick turns into lag rather than a pile of
+    overlapping ticks. Return the number of notifications left behind.
+
+    Every tick is recorded as a DispatcherTick (see aquaholic.metrics),
+    tick_id names the queued DispatcherTick to fill in. clock returns the
+    current time, timezone.now unless the simulator passes a virtual one.
+    """
+    clock = clock or timezone.now
+    budget = settings.NOTIFICATION_TICK_BUDGET
+    started = time.monotonic()
+    deadline = started + budget
+    holder = worker_name()
+    now = clock()
+    if tick_id is not None:
+        DispatcherTick.objects.filter(id=tick_id).update(status=DispatcherTick.RUNNING, started_time=now)
+    stats = TickStats()
+    # the lease outlives the budget so it only expires if the tick died
+    if acquire_tick_lock(holder, now, budget * 2):
+        try:
+            stats.due, enqueued = enqueue_due_schedules(now)
+            # coalesced, stale and token-less reminders get no message
+            stats.skipped += stats.due - enqueued
+            purge_outbox(now)
+            purge_ticks(now)
+            rollover_schedules(now)
+        finally:
+            release_tick_lock(holder)
+    else:
+        logger.info("Another tick is enqueueing, this tick only drains the outbox")
+    drain_outbox(now, worker=holder, deadline=deadline, stats=stats, clock=clock)
+    left = backlog(now)
+    if left:
+        logger.warning("Notification tick left %d due notifications for the next tick", left)
+    stats.save(now, time.monotonic() - started, left, tick_id)
+    return left
+
+
+def run_tick(tick_id):
+    """Run the queued tick tick_id, in a background thread, and mark it failed if it raises."""
+    try:
+        update_notification(tick_id=tick_id)
+    except Exception:
+        logger.exception("Notification tick %s failed", tick_id)
+        DispatcherTick.objects.filter(id=tick_id).update(status=DispatcherTick.FAILED, finished_time=timezone.now())
+    finally:
+        connection.close()
+
+
+def start_tick():
+    """Queue a tick and run it in a background thread, return its DispatcherTick.
+
+    While a queued or running tick is younger than twice the tick budget it
+    is returned instead, so retried pings do not start more ticks. The check
+    and the insert run in one transaction that first writes the START_LOCK
+    DispatcherLock row, so concurrent pings take turns and only one of them
+    queues a tick.
+    """
+    now = timezone.now()
+    DispatcherLock.objects.get_or_create(name=START_LOCK)
+    with transaction.atomic():
+        # the UPDATE locks the row until commit, on every database
+        DispatcherLock.objects.filter(name=START_LOCK).update(lease_until=now)
+        in_flight = DispatcherTick.objects.filter(
+            status__in=[DispatcherTick.QUEUED, DispatcherTick.RUNNING],
+            started_time__gte=now - timezone.timedelta(seconds=settings.NOTIFICATION_TICK_BUDGET * 2))
+        tick = in_flight.order_by('-started_time').first()
+        if tick is not None:
+            return tick
+        tick = DispatcherTick.objects.create(status=DispatcherTick.QUEUED, started_time=now)
+    threading.Thread(target=run_tick, args=(tick.id,), daemon=True).start()
+    return tick
+
+
+def rollover_schedules(now):
+    """Move the schedules of every user whose last notification has fired to the next day.
+
+    The whole rollover is a handful of set-based UPDATE statements in one
+    transaction, however many users and reminders are affected. Schedules
+    of users who turned notification on are reset to not-sent, the others
+    keep their status. Users without a valid LINE token are never enqueued,
+    their schedules move on once the time of their last notification has
+    passed.
+    """
+    with transaction.atomic():
+        finished_users = Schedule.objects.filter(Q(notification_status=True) | Q(user_info__notify_token_valid=False),
+                                                 is_last=True, notification_time__lte=now,
+                                                 user_info__isnull=False)
+        turned_on = dict(finished_users.values_list('user_info_id', 'user_info__notification_turned_on').distinct())
+        for user_ids in chunked(turned_on):
+            turned_on_ids = [user_id for user_id in user_ids if turned_on[user_id]]
+            Schedule.objects.filter(user_info_id__in=user_ids).update(
+                notification_time=F('notification_time') + timezone.timedelta(hours=24),
+                notification_status=Case(When(user_info_id__in=turned_on_ids, then=Value(False)),
+                                         default=F('notification_status'))
+            )
+
+
+def token_status(token):
+    """Return LINE's status for token, or None when LINE could not be asked."""
+    try:
+        return check_token_status(token)
+    except requests.RequestException:
+        return None
+
+
+def refresh_token_status():
+    """Cron job for checking every stored LINE notify token.
+
+    The tokens are checked concurrently and the result is stored in
+    UserInfo.notify_token_valid, so that pages never have to ask LINE
+    whether a user is connected. Only a 401 marks a token invalid. A token
+    LINE could not vouch for either way (429, 5xx or no answer) keeps its
+    stored state, so an outage during the sweep does not silence anyone.
+    Return the number of tokens checked.
     """
-    all_to_send = Schedule.objects.filter(notification_time__lte=timezone.now(),
-                                          notification_status=False)
-    for one_to_send in all_to_send:
-        send_notification(f"Don't forget to drink {one_to_send.expected_amount} ml of water",
-                          one_to_send.user_info.notify_token)
-        one_to_send.notification_status = True
-        one_to_send.save()
-
-    last_to_send = Schedule.objects.filter(notification_status=True, is_last=True,
-                                           notification_time__lte=timezone.now())
-    for last_schedule in last_to_send:
-        user_info = last_schedule.user_info
-        user_schedule = Schedule.objects.filter(user_info=user_info)
-        if user_info.notification_turned_on:
-            for schedule in user_schedule:
-                schedule.notification_time += timezone.timedelta(hours=24)
-                schedule.notification_status = False
-                schedule.save()
-        else:
-            for schedule in user_schedule:
-                schedule.notification_time += timezone.timedelta(hours=24)
-                schedule.save()
+    now = timezone.now()
+    tokens = list(UserInfo.objects.exclude(notify_token__isnull=True).exclude(notify_token='')
+                  .values_list('id', 'notify_token'))
+    if not tokens:
+        return 0
+    with ThreadPoolExecutor(max_workers=min(settings.NOTIFICATION_WORKERS, len(tokens))) as executor:
+        statuses = list(executor.map(token_status, [token for _, token in tokens]))
+    checked = defaultdict(list)
+    for (user_info_id, _), status in zip(tokens, statuses):
+        if status in (200, 401):
+            checked[status == 200].append(user_info_id)
+    for is_valid, user_info_ids in checked.items():
+        for ids in chunked(user_info_ids):
+            UserInfo.objects.filter(id__in=ids).update(notify_token_valid=is_valid, notify_token_checked_time=now)
+    return sum(len(user_info_ids) for user_info_ids in checked.values())
@@ -0,0 +1,99 @@
+"""A module that fans LINE notifications out over a pool of worker threads."""
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
+import requests
+from django.conf import settings
+
+from .notification import NotificationUnavailable, notify
+from .throttle import SendDeferred, SendThrottle
+
+# outcome of a single send, error is None when LINE accepted or refused it for good,
+# latency is the seconds LINE took to answer (None when LINE was not called)
+SendResult = namedtuple('SendResult', ['job_id', 'status', 'error', 'latency'], defaults=[None])
+
+
+def reminder_message(expected_amount):
+    """Return the reminder message for the given amount of water."""
+    return f"Don't forget to drink {expected_amount} ml of water"
+
+
+_throttle = None
+_throttle_lock = threading.Lock()
+
+
+def get_throttle():
+    """Return the SendThrottle of this process, creating it on first use."""
+    global _throttle
+    with _throttle_lock:
+        if _throttle is None:
+            _throttle = SendThrottle(max_rate=settings.NOTIFICATION_MAX_RATE,
+                                     burst=settings.NOTIFICATION_BURST,
+                                     max_wait=settings.NOTIFICATION_THROTTLE_WAIT)
+        return _throttle
+
+
+def send_one(job_id, message, token, throttle):
+    """Send one notification through throttle and wrap the outcome in a SendResult.
+
+    Sends that would go over LINE's rate limit, sends LINE answered with
+    429, and sends refused by the open circuit breaker come back with a
+    SendDeferred error so they are retried later without counting as an
+    attempt. Sends LINE still answered with 5xx after the client's own
+    retries, and sends without a token, come back with an HTTPError and
+    count as failed attempts.
+    """
+    if token and not throttle.acquire(token):
+        return SendResult(job_id, None, SendDeferred("over the LINE rate limit"))
+    started = time.monotonic()
+    try:
+        result = notify(message, token)
+    except NotificationUnavailable:
+        # LINE was not called, so this is no failed attempt
+        return SendResult(job_id, None, SendDeferred("LINE circuit breaker is open"))
+    except requests.RequestException as error:
+        return SendResult(job_id, None, error, time.monotonic() - started)
+    latency = time.monotonic() - started if token else None
+    if token:
+        throttle.update(token, result.status, result.rate_limit)
+    if result.status == 429:
+        return SendResult(job_id, 429, SendDeferred("LINE answered 429"), latency)
+    if result.status is None or result.status >= 500:
+        # nothing was delivered, retry it like a failed request
+        reason = "no LINE token" if result.status is None else f"LINE answered {result.status}"
+        return SendResult(job_id, result.status, requests.HTTPError(reason), latency)
+    return SendResult(job_id, result.status, None, latency)
+
+
+def send_all(jobs, max_workers=None, throttle=None):
+    """Send every (job id, message, token) job concurrently.
+
+    The jobs are spread over a bounded thread pool whose size comes from
+    settings.NOTIFICATION_WORKERS unless max_workers is given. Workers only
+    talk to LINE, they never touch the database, so the caller can apply
+    the results in bulk afterwards.
+    """
+    jobs = list(jobs)
+    if not jobs:
+        return []
+    max_workers = max_workers or settings.NOTIFICATION_WORKERS
+    throttle = throttle or get_throttle()
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(jobs))) as executor:
+        futures = [executor.submit(send_one, *job, throttle) for job in jobs]
+        return [future.result() for future in futures]
+
+
+def chunked(items, size=500):
+    """Split items into lists of at most size elements (keeps IN clauses small).
+
+    items is consumed lazily, so it can be a generator too large to hold.
+    """
+    items = iter(items)
+    while True:
+        chunk = list(islice(items, size))
+        if not chunk:
+            return
+        yield chunk
@@ -0,0 +1,168 @@
+"""A local stand-in for the LINE Notify APIs, for tests and load benchmarks.
+
+LineNotifyEmulator serves /api/notify, /api/status and /oauth/token the way
+LINE does, from a thread of the current process. Point
+settings.LINE_NOTIFY_API_URL and settings.LINE_NOTIFY_BOT_URL at its url to
+use it instead of LINE.
+"""
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+
+def constant(seconds):
+    """Return a latency distribution that always waits seconds."""
+    return lambda rng: seconds
+
+
+def uniform(low, high):
+    """Return a latency distribution uniform between low and high seconds."""
+    return lambda rng: rng.uniform(low, high)
+
+
+def lognormal(median, sigma):
+    """Return a long-tailed latency distribution around median seconds."""
+    return lambda rng: median * rng.lognormvariate(0, sigma)
+
+
+class LineNotifyEmulator:
+    """An HTTP server answering like LINE Notify.
+
+    Tokens are valid when they are in tokens, were issued by /oauth/token,
+    or when accept_any_token is set; tokens in revoked_tokens are always
+    refused with 401. Authorization codes in codes are exchanged for a
+    token "token-<code>", other codes are refused. Every token may notify
+    rate_limit times per rate_limit_window seconds and gets LINE's
+    X-RateLimit-* headers, then 429. A share error_rate of the calls fails
+    with 500, and every call waits a delay drawn from latency.
+    """
+
+    def __init__(self, latency=None, error_rate=0, tokens=(), revoked_tokens=(), codes=(),
+                 accept_any_token=False, rate_limit=1000, rate_limit_window=3600, seed=None):
+        self.latency = latency or constant(0)
+        self.error_rate = error_rate
+        self.tokens = set(tokens)
+        self.revoked_tokens = set(revoked_tokens)
+        self.codes = set(codes)
+        self.accept_any_token = accept_any_token
+        self.rate_limit = rate_limit
+        self.rate_limit_window = rate_limit_window
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.budgets = {}
+        self.messages = []
+        self.calls = 0
+        self.server = None
+        self.thread = None
+
+    @property
+    def url(self):
+        """Return the base url the emulator listens on."""
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self, host='127.0.0.1', port=0):
+        """Start serving in a background thread, on a free port unless port is given."""
+        handler = type('Handler', (EmulatorHandler,), {'emulator': self})
+        self.server = ThreadingHTTPServer((host, port), handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """Stop serving and close the socket."""
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def is_valid(self, token):
+        """Return whether token is accepted."""
+        if not token or token in self.revoked_tokens:
+            return False
+        return self.accept_any_token or token in self.tokens
+
+    def take_call(self, token):
+        """Use one call of token's budget, return the (remaining, reset) after it, remaining -1 when over."""
+        now = time.time()
+        with self.lock:
+            remaining, reset = self.budgets.get(token, (self.rate_limit, int(now) + self.rate_limit_window))
+            if now >= reset:
+                remaining, reset = self.rate_limit, int(now) + self.rate_limit_window
+            remaining -= 1
+            self.budgets[token] = (max(remaining, 0), reset)
+            return remaining, reset
+
+    def answer(self, method, path, headers, form):
+        """Return the (status, headers, body) LINE would answer with."""
+        with self.lock:
+            self.calls += 1
+            delay = self.latency(self.random)
+            fails = self.random.random() < self.error_rate
+        time.sleep(max(delay, 0))
+        if fails:
+            return 500, {}, {'status': 500, 'message': "Internal server error"}
+        if path == '/oauth/token' and method == 'POST':
+            code = form.get('code')
+            if code not in self.codes:
+                return 400, {}, {'status': 400, 'message': "invalid authorization code"}
+            token = f"token-{code}"
+            with self.lock:
+                self.tokens.add(token)
+            return 200, {}, {'access_token': token}
+        authorization = headers.get('Authorization', '')
+        token = authorization[len('Bearer '):] if authorization.startswith('Bearer ') else ''
+        if path == '/api/status' and method == 'GET':
+            if not self.is_valid(token):
+                return 401, {}, {'status': 401, 'message': "Invalid access token"}
+            return 200, {}, {'status': 200, 'message': "ok", 'targetType': "USER", 'target': "emulator"}
+        if path == '/api/notify' and method == 'POST':
+            if not self.is_valid(token):
+                return 401, {}, {'status': 401, 'message': "Invalid access token"}
+            remaining, reset = self.take_call(token)
+            rate_headers = {'X-RateLimit-Limit': str(self.rate_limit),
+                            'X-RateLimit-Remaining': str(max(remaining, 0)),
+                            'X-RateLimit-Reset': str(reset)}
+            if remaining < 0:
+                return 429, rate_headers, {'status': 429, 'message': "Too Many Requests"}
+            with self.lock:
+                self.messages.append((token, form.get('message')))
+            return 200, rate_headers, {'status': 200, 'message': "ok"}
+        return 404, {}, {'status': 404, 'message': "Not found"}
+
+
+class EmulatorHandler(BaseHTTPRequestHandler):
+    """Request handler passing every call to its emulator."""
+
+    emulator = None
+    protocol_version = 'HTTP/1.1'
+
+    def handle_call(self):
+        """Answer one call with the emulator's response."""
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length).decode() if length else ''
+        form = {key: values[0] for key, values in parse_qs(body).items()}
+        status, headers, payload = self.emulator.answer(self.command, self.path, self.headers, form)
+        content = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+    do_GET = handle_call
+    do_POST = handle_call
+
+    def log_message(self, format, *args):
+        """Keep the console quiet."""
@@ -0,0 +1,125 @@
+"""Command for benchmarking the notification dispatcher."""
+import datetime
+import json
+import platform
+import random
+import resource
+import sys
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.utils import timezone
+
+from aquaholic import dispatcher
+from aquaholic.cron import rollover_schedules, update_notification
+from aquaholic.line_emulator import LineNotifyEmulator, lognormal
+from aquaholic.models import DispatcherTick, Schedule, UserInfo
+from aquaholic.simulator import random_user_info
+
+
+def seed(users, now, rng, batch_size=5000):
+    """Create users with realistic reminder settings and one day of schedules each.
+
+    Every user's first reminder is due one minute before now, so the tick
+    that follows has one due reminder per user. Return the number of
+    schedules created.
+    """
+    schedules = 0
+    for start in range(0, users, batch_size):
+        user_infos = [random_user_info(rng, number) for number in range(start, min(start + batch_size, users))]
+        user_infos = UserInfo.objects.bulk_create(user_infos)
+        first = now - datetime.timedelta(minutes=1)
+        rows = [Schedule(user_info=user_info, expected_amount=user_info.water_amount_per_hour,
+                         notification_time=first + datetime.timedelta(hours=user_info.time_interval * i),
+                         notification_status=False, is_last=i == user_info.notification_count - 1)
+                for user_info in user_infos for i in range(user_info.notification_count)]
+        Schedule.objects.bulk_create(rows, batch_size=batch_size)
+        schedules += len(rows)
+    return schedules
+
+
+def peak_rss_kb():
+    """Return the peak resident set size of this process in kilobytes."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+
+class Command(BaseCommand):
+    """Seed a throwaway test database and time one dispatcher tick and one rollover on it.
+
+    Sends go to the local LINE Notify emulator. The report is printed as JSON
+    so runs on different commits can be compared.
+    """
+
+    help = "Benchmark update_notification against the LINE Notify emulator and print JSON results."
+
+    def add_arguments(self, parser):
+        """Add the benchmark options."""
+        parser.add_argument('--users', type=int, nargs='+', default=[10000],
+                            help="Number of users to seed, one run per value (e.g. 10000 100000 1000000).")
+        parser.add_argument('--latency-ms', type=float, default=20,
+                            help="Median latency of the emulated LINE API, in milliseconds.")
+        parser.add_argument('--error-rate', type=float, default=0,
+                            help="Share of the emulated calls answered with 500.")
+        parser.add_argument('--max-rate', type=float, default=None,
+                            help="Sends per second allowed by the throttle, defaults to NOTIFICATION_MAX_RATE.")
+        parser.add_argument('--seed', type=int, default=0, help="Seed for the generated users and latencies.")
+        parser.add_argument('--output', default=None, help="Write the JSON report to this file as well.")
+
+    def handle(self, *args, **options):
+        """Run one benchmark per requested number of users and print the report."""
+        report = {'python': platform.python_version(), 'database': connection.vendor,
+                  'latency_ms': options['latency_ms'], 'error_rate': options['error_rate'], 'runs': []}
+        for users in sorted(options['users']):
+            report['runs'].append(self.run(users, options))
+        output = json.dumps(report, indent=2)
+        self.stdout.write(output)
+        if options['output']:
+            with open(options['output'], 'w') as file:
+                file.write(output + "\n")
+
+    def run(self, users, options):
+        """Benchmark one database of users and return its results."""
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            return self.measure(users, options)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    def measure(self, users, options):
+        """Seed users, run one tick and one rollover, and return the measurements."""
+        rng = random.Random(options['seed'])
+        now = timezone.now()
+        started = time.perf_counter()
+        schedules = seed(users, now, rng)
+        seed_seconds = time.perf_counter() - started
+        emulator = LineNotifyEmulator(latency=lognormal(options['latency_ms'] / 1000, 0.5),
+                                      error_rate=options['error_rate'], accept_any_token=True,
+                                      seed=options['seed'])
+        max_rate = options['max_rate'] or 10 ** 9
+        with emulator, override_settings(LINE_NOTIFY_API_URL=emulator.url, LINE_NOTIFY_BOT_URL=emulator.url,
+                                         NOTIFICATION_MAX_RATE=max_rate, NOTIFICATION_BURST=int(min(max_rate, 10 ** 6)),
+                                         NOTIFICATION_TICK_BUDGET=10 ** 6):
+            # the throttle is built from the settings on first use
+            dispatcher._throttle = None
+            with CaptureQueriesContext(connection) as queries:
+                started = time.perf_counter()
+                update_notification()
+                tick_seconds = time.perf_counter() - started
+            dispatcher._throttle = None
+        tick = DispatcherTick.objects.latest('started_time')
+        Schedule.objects.update(notification_status=True, notification_time=now - datetime.timedelta(hours=1))
+        started = time.perf_counter()
+        rollover_schedules(now)
+        rollover_seconds = time.perf_counter() - started
+        return {'users': users, 'schedules': schedules, 'seed_seconds': round(seed_seconds, 3),
+                'due': tick.due, 'sent': tick.sent, 'failed': tick.failed, 'deferred': tick.deferred,
+                'tick_seconds': round(tick_seconds, 3),
+                'sends_per_second': round(tick.sent / tick_seconds, 1) if tick_seconds else None,
+                'queries_per_tick': len(queries.captured_queries),
+                'latency_p50': tick.latency_p50, 'latency_p95': tick.latency_p95, 'latency_p99': tick.latency_p99,
+                'max_lag_seconds': tick.max_lag, 'rollover_seconds': round(rollover_seconds, 3),
+                'peak_rss_kb': peak_rss_kb(), 'emulator_calls': emulator.calls}
@@ -0,0 +1,15 @@
+"""Command for checking every stored LINE notify token."""
+from django.core.management.base import BaseCommand
+
+from aquaholic.cron import refresh_token_status
+
+
+class Command(BaseCommand):
+    """Re-validate the LINE notify token of every user and store the result."""
+
+    help = "Check every stored LINE notify token and save whether it is still valid."
+
+    def handle(self, *args, **options):
+        """Run the token sweep."""
+        checked = refresh_token_status()
+        self.stdout.write(f"Checked {checked} LINE notify tokens.")
@@ -0,0 +1,74 @@
+"""Command for running the notification dispatcher as a long-lived process."""
+import signal
+import threading
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from django.utils import timezone
+
+from aquaholic.cron import update_notification
+from aquaholic.scheduler import DueQueue
+
+
+class Command(BaseCommand):
+    """Send notifications on time from one process instead of a crontab entry per minute.
+
+    The upcoming due times are kept in a DueQueue. The process sleeps until
+    the next one, runs aquaholic.cron.update_notification, and reloads the
+    queue every --refresh seconds to pick up schedule changes.
+    """
+
+    help = "Run the notification dispatcher until interrupted."
+
+    def add_arguments(self, parser):
+        """Add the tuning options."""
+        parser.add_argument('--horizon', type=int, default=3600,
+                            help="Seconds ahead of now loaded into the queue.")
+        parser.add_argument('--refresh', type=int, default=30,
+                            help="Seconds between reloads of the queue.")
+        parser.add_argument('--retry-interval', type=int, default=60,
+                            help="Seconds before notifications left over by a tick are tried again.")
+        parser.add_argument('--max-ticks', type=int, default=None,
+                            help="Stop after this many ticks (mainly for testing).")
+
+    def handle(self, *args, **options):
+        """Run the dispatch loop."""
+        self.stopping = threading.Event()
+        handlers = {}
+        if threading.current_thread() is threading.main_thread():
+            for signum in (signal.SIGTERM, signal.SIGINT):
+                handlers[signum] = signal.signal(signum, lambda *_: self.stopping.set())
+        try:
+            ticks = self.run(**options)
+        finally:
+            for signum, handler in handlers.items():
+                signal.signal(signum, handler)
+        self.stdout.write(f"Dispatcher stopped after {ticks} ticks.")
+
+    def run(self, horizon, refresh, retry_interval, max_ticks, **options):
+        """Sleep until the next due time, run a tick, repeat until stopped. Return the number of ticks."""
+        queue = DueQueue(horizon)
+        ticks = 0
+        last_tick = None
+        next_refresh = 0
+        while not self.stopping.is_set():
+            if time.monotonic() >= next_refresh:
+                close_old_connections()
+                queue.load(timezone.now(), last_tick, retry_interval)
+                next_refresh = time.monotonic() + refresh
+            now = timezone.now()
+            if queue.pop_due(now):
+                close_old_connections()
+                update_notification()
+                ticks += 1
+                if max_ticks is not None and ticks >= max_ticks:
+                    break
+                last_tick = now
+                next_refresh = 0
+                continue
+            wait = next_refresh - time.monotonic()
+            if queue.next_due() is not None:
+                wait = min(wait, queue.next_due() - now.timestamp())
+            self.stopping.wait(max(wait, 0))
+        return ticks
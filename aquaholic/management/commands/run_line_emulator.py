@@ -0,0 +1,43 @@
+"""Command for running the local LINE Notify emulator."""
+import threading
+
+from django.core.management.base import BaseCommand
+
+from aquaholic.line_emulator import LineNotifyEmulator, lognormal
+
+
+class Command(BaseCommand):
+    """Serve the LINE Notify APIs locally so the app can run and be load tested without LINE.
+
+    Set LINE_NOTIFY_API_URL and LINE_NOTIFY_BOT_URL to the printed url.
+    """
+
+    help = "Run a local LINE Notify emulator until interrupted."
+
+    def add_arguments(self, parser):
+        """Add the emulator options."""
+        parser.add_argument('--port', type=int, default=8900)
+        parser.add_argument('--latency-ms', type=float, default=50,
+                            help="Median latency of a call, in milliseconds.")
+        parser.add_argument('--latency-sigma', type=float, default=0.5,
+                            help="Spread of the log-normal latency, 0 for a constant latency.")
+        parser.add_argument('--error-rate', type=float, default=0,
+                            help="Share of the calls answered with 500.")
+        parser.add_argument('--rate-limit', type=int, default=1000,
+                            help="Calls per hour allowed for each token.")
+        parser.add_argument('--revoked', nargs='*', default=[],
+                            help="Tokens answered with 401, every other token is accepted.")
+
+    def handle(self, *args, **options):
+        """Serve until interrupted."""
+        emulator = LineNotifyEmulator(latency=lognormal(options['latency_ms'] / 1000, options['latency_sigma']),
+                                      error_rate=options['error_rate'], rate_limit=options['rate_limit'],
+                                      revoked_tokens=options['revoked'], accept_any_token=True)
+        emulator.start(port=options['port'])
+        self.stdout.write(f"LINE Notify emulator listening on {emulator.url}")
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            emulator.stop()
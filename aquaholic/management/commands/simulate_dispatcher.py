@@ -0,0 +1,47 @@
+"""Command for replaying days of dispatcher ticks against a virtual clock."""
+import datetime
+import json
+import random
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.utils import timezone
+
+from aquaholic.simulator import Simulation
+
+
+class Command(BaseCommand):
+    """Seed a throwaway test database and replay days of cron ticks on it in seconds.
+
+    The report (sends, late and duplicate sends, writes and Schedule rows per
+    simulated day, sends per minute of the day) is printed as JSON.
+    """
+
+    help = "Simulate days of notification ticks with a virtual clock and print JSON results."
+
+    def add_arguments(self, parser):
+        """Add the simulation options."""
+        parser.add_argument('--users', type=int, default=1000)
+        parser.add_argument('--days', type=int, default=30)
+        parser.add_argument('--tick-minutes', type=int, default=1,
+                            help="Minutes between two cron ticks.")
+        parser.add_argument('--seed', type=int, default=0, help="Seed for the generated users.")
+        parser.add_argument('--output', default=None, help="Write the JSON report to this file as well.")
+
+    def handle(self, *args, **options):
+        """Run the simulation on a test database and print the report."""
+        start = timezone.make_aware(datetime.datetime.combine(timezone.localdate(), datetime.time()))
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            simulation = Simulation(options['users'], options['days'], start, random.Random(options['seed']),
+                                    tick_minutes=options['tick_minutes'])
+            simulation.seed()
+            report = simulation.run()
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+        output = json.dumps(report, indent=2)
+        self.stdout.write(output)
+        if options['output']:
+            with open(options['output'], 'w') as file:
+                file.write(output + "\n")
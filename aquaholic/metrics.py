@@ -0,0 +1,101 @@
+"""A module that records what every notification tick did, for monitoring the dispatcher."""
+import logging
+import math
+
+from django.conf import settings
+from django.utils import timezone
+
+from .models import DispatcherCounter, DispatcherTick
+from .throttle import SendDeferred
+
+logger = logging.getLogger(__name__)
+
+
+def percentile(values, percent):
+    """Return the nearest-rank percentile of values, None when there are none."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(math.ceil(percent / 100 * len(ordered)) - 1, 0)]
+
+
+class TickStats:
+    """Counters of one notification tick, filled in while the tick runs."""
+
+    def __init__(self):
+        self.due = 0
+        self.sent = 0
+        self.failed = 0
+        self.skipped = 0
+        self.deferred = 0
+        self.latencies = []
+        self.max_lag = 0.0
+
+    def record_sends(self, results, scheduled_times, sent_time):
+        """Count the SendResults of one batch.
+
+        Only sends LINE answered with 2xx count as sent, every other answer
+        or error that is not deferred counts as failed. scheduled_times maps
+        each job id to the time its earliest reminder was due, the lag of a
+        sent reminder is how long after that it went out.
+        """
+        for result in results:
+            if result.latency is not None:
+                self.latencies.append(result.latency)
+            if isinstance(result.error, SendDeferred):
+                self.deferred += 1
+            elif result.error is None and result.status is not None and 200 <= result.status < 300:
+                self.sent += 1
+                lag = (sent_time - scheduled_times[result.job_id]).total_seconds()
+                self.max_lag = max(self.max_lag, lag)
+            else:
+                self.failed += 1
+
+    def save(self, started_time, duration, backlog, tick_id=None):
+        """Store the tick as a finished DispatcherTick and log it in one key=value line.
+
+        The DispatcherTick tick_id is filled in when the tick was queued
+        beforehand, otherwise a new one is created.
+        """
+        fields = dict(status=DispatcherTick.DONE, started_time=started_time, finished_time=timezone.now(),
+                      duration=duration, due=self.due, sent=self.sent, failed=self.failed, skipped=self.skipped,
+                      deferred=self.deferred, backlog=backlog, max_lag=self.max_lag,
+                      latency_p50=percentile(self.latencies, 50), latency_p95=percentile(self.latencies, 95),
+                      latency_p99=percentile(self.latencies, 99))
+        if tick_id is None:
+            DispatcherTick.objects.create(**fields)
+        else:
+            DispatcherTick.objects.filter(id=tick_id).update(**fields)
+        logger.info("notification_tick due=%(due)d sent=%(sent)d failed=%(failed)d skipped=%(skipped)d "
+                    "deferred=%(deferred)d backlog=%(backlog)d max_lag=%(max_lag).1f duration=%(duration).3f "
+                    "latency_p50=%(latency_p50)s latency_p95=%(latency_p95)s latency_p99=%(latency_p99)s", fields)
+
+
+def purge_ticks(now):
+    """Delete ticks older than settings.NOTIFICATION_OUTBOX_RETENTION days."""
+    DispatcherTick.objects.filter(
+        started_time__lt=now - timezone.timedelta(days=settings.NOTIFICATION_OUTBOX_RETENTION)).delete()
+
+
+def render_metrics():
+    """Return the latest tick and the dispatcher counters in the Prometheus text format."""
+    lines = []
+    tick = DispatcherTick.objects.filter(status=DispatcherTick.DONE).order_by('-started_time').first()
+    if tick is not None:
+        values = [('last_tick_timestamp_seconds', tick.started_time.timestamp()),
+                  ('tick_duration_seconds', tick.duration),
+                  ('tick_due', tick.due),
+                  ('tick_sent', tick.sent),
+                  ('tick_failed', tick.failed),
+                  ('tick_skipped', tick.skipped),
+                  ('tick_deferred', tick.deferred),
+                  ('tick_backlog', tick.backlog),
+                  ('tick_max_lag_seconds', tick.max_lag)]
+        for name, value in values:
+            lines.append(f"aquaholic_{name} {value}")
+        for quantile, value in (('0.5', tick.latency_p50), ('0.95', tick.latency_p95), ('0.99', tick.latency_p99)):
+            if value is not None:
+                lines.append(f'aquaholic_send_latency_seconds{{quantile="{quantile}"}} {value}')
+    lines.append(f"aquaholic_tokens_pruned_total "
+                 f"{DispatcherCounter.get_value(DispatcherCounter.TOKENS_PRUNED)}")
+    return "\n".join(lines) + "\n"
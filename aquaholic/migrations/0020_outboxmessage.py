@@ -0,0 +1,88 @@
+# Generated by Django 4.1 on 2026-10-18 12:27
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("aquaholic", "0019_userinfo_notification_turned_on"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="OutboxMessage",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("scheduled_time", models.DateTimeField(verbose_name="scheduled time")),
+                ("expected_amount", models.IntegerField(default=0)),
+                (
+                    "status",
+                    models.CharField(
+                        choices=[
+                            ("pending", "Pending"),
+                            ("sent", "Sent"),
+                            ("dead", "Dead"),
+                        ],
+                        default="pending",
+                        max_length=10,
+                    ),
+                ),
+                ("attempts", models.IntegerField(default=0)),
+                (
+                    "next_attempt_time",
+                    models.DateTimeField(
+                        default=django.utils.timezone.now,
+                        verbose_name="next attempt time",
+                    ),
+                ),
+                (
+                    "last_error",
+                    models.CharField(blank=True, default="", max_length=200),
+                ),
+                ("response_status", models.IntegerField(null=True)),
+                (
+                    "sent_time",
+                    models.DateTimeField(null=True, verbose_name="sent time"),
+                ),
+                (
+                    "schedule",
+                    models.ForeignKey(
+                        null=True,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="aquaholic.schedule",
+                    ),
+                ),
+                (
+                    "user_info",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="aquaholic.userinfo",
+                    ),
+                ),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name="outboxmessage",
+            index=models.Index(
+                fields=["status", "next_attempt_time"], name="outbox_status_next_idx"
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name="outboxmessage",
+            constraint=models.UniqueConstraint(
+                fields=("schedule", "scheduled_time"),
+                name="unique_outbox_schedule_time",
+            ),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 4.1 on 2026-10-18 12:28
+
+from django.db import migrations, models
+
+
+def trust_stored_tokens(apps, schema_editor):
+    """Treat every stored token as valid until the first token sweep checks it."""
+    UserInfo = apps.get_model("aquaholic", "UserInfo")
+    UserInfo.objects.exclude(notify_token__isnull=True).exclude(notify_token="").update(
+        notify_token_valid=True
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("aquaholic", "0020_outboxmessage"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="userinfo",
+            name="notify_token_checked_time",
+            field=models.DateTimeField(
+                null=True, verbose_name="notify token checked time"
+            ),
+        ),
+        migrations.AddField(
+            model_name="userinfo",
+            name="notify_token_valid",
+            field=models.BooleanField(default=False),
+        ),
+        migrations.RunPython(trust_stored_tokens, migrations.RunPython.noop),
+    ]
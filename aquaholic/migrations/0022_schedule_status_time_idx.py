@@ -0,0 +1,20 @@
+# Generated by Django 4.1 on 2026-10-18 12:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("aquaholic", "0021_userinfo_notify_token_valid"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="schedule",
+            index=models.Index(
+                fields=["notification_status", "notification_time"],
+                name="schedule_status_time_idx",
+            ),
+        ),
+    ]
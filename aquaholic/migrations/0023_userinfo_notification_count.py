@@ -0,0 +1,29 @@
+# Generated by Django 4.1 on 2026-10-18 12:31
+
+from django.db import migrations, models
+
+
+def set_notification_count(apps, schema_editor):
+    """Fill the number of notifications per day of users who set up a schedule."""
+    UserInfo = apps.get_model("aquaholic", "UserInfo")
+    for user_info in UserInfo.objects.exclude(total_hours__isnull=True):
+        user_info.notification_count = (
+            int(user_info.total_hours / user_info.time_interval) + 1
+        )
+        user_info.save(update_fields=["notification_count"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("aquaholic", "0022_schedule_status_time_idx"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="userinfo",
+            name="notification_count",
+            field=models.IntegerField(default=0),
+        ),
+        migrations.RunPython(set_notification_count, migrations.RunPython.noop),
+    ]
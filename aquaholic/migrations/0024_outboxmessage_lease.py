@@ -0,0 +1,23 @@
+# Generated by Django 4.1 on 2026-10-18 12:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("aquaholic", "0023_userinfo_notification_count"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="outboxmessage",
+            name="claimed_by",
+            field=models.CharField(blank=True, default="", max_length=100),
+        ),
+        migrations.AddField(
+            model_name="outboxmessage",
+            name="lease_until",
+            field=models.DateTimeField(null=True, verbose_name="lease until"),
+        ),
+    ]
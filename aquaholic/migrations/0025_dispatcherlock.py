@@ -0,0 +1,33 @@
+# Generated by Django 4.1 on 2026-10-18 12:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("aquaholic", "0024_outboxmessage_lease"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="DispatcherLock",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("name", models.CharField(max_length=50, unique=True)),
+                ("holder", models.CharField(blank=True, default="", max_length=100)),
+                (
+                    "lease_until",
+                    models.DateTimeField(null=True, verbose_name="lease until"),
+                ),
+            ],
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 4.1 on 2026-10-18 12:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("aquaholic", "0025_dispatcherlock"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="DispatcherCounter",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("name", models.CharField(max_length=50, unique=True)),
+                ("value", models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.AddField(
+            model_name="userinfo",
+            name="notify_auth_failures",
+            field=models.IntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 4.1 on 2026-10-18 12:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("aquaholic", "0026_notify_auth_failures"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="outboxmessage",
+            name="status",
+            field=models.CharField(
+                choices=[
+                    ("pending", "Pending"),
+                    ("sent", "Sent"),
+                    ("dead", "Dead"),
+                    ("skipped", "Skipped"),
+                ],
+                default="pending",
+                max_length=10,
+            ),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 4.1 on 2026-10-18 12:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("aquaholic", "0027_outboxmessage_skipped"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="schedule",
+            index=models.Index(
+                fields=["notification_time", "user_info"], name="schedule_time_user_idx"
+            ),
+        ),
+    ]
@@ -0,0 +1,42 @@
+# Generated by Django 4.1 on 2026-10-18 12:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("aquaholic", "0028_schedule_time_user_idx"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="DispatcherTick",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "started_time",
+                    models.DateTimeField(db_index=True, verbose_name="started time"),
+                ),
+                ("duration", models.FloatField(default=0)),
+                ("due", models.IntegerField(default=0)),
+                ("sent", models.IntegerField(default=0)),
+                ("failed", models.IntegerField(default=0)),
+                ("skipped", models.IntegerField(default=0)),
+                ("deferred", models.IntegerField(default=0)),
+                ("backlog", models.IntegerField(default=0)),
+                ("max_lag", models.FloatField(default=0)),
+                ("latency_p50", models.FloatField(null=True)),
+                ("latency_p95", models.FloatField(null=True)),
+                ("latency_p99", models.FloatField(null=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 4.1 on 2026-10-18 12:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("aquaholic", "0029_dispatchertick"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="dispatchertick",
+            name="finished_time",
+            field=models.DateTimeField(null=True, verbose_name="finished time"),
+        ),
+        migrations.AddField(
+            model_name="dispatchertick",
+            name="status",
+            field=models.CharField(
+                choices=[
+                    ("queued", "Queued"),
+                    ("running", "Running"),
+                    ("done", "Done"),
+                    ("skipped", "Skipped"),
+                    ("failed", "Failed"),
+                ],
+                default="done",
+                max_length=10,
+            ),
+        ),
+    ]
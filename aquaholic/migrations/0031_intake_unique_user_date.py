@@ -0,0 +1,40 @@
+# Generated by Django 4.1 on 2026-10-18 12:47
+
+from django.db import migrations, models
+from django.db.models import Count, Sum
+
+
+def merge_duplicate_intakes(apps, schema_editor):
+    """Merge intakes of the same user and date into one row holding their total."""
+    Intake = apps.get_model("aquaholic", "Intake")
+    duplicates = (
+        Intake.objects.exclude(user_info__isnull=True)
+        .values("user_info_id", "date")
+        .annotate(rows=Count("id"), total=Sum("total_amount"))
+        .filter(rows__gt=1)
+    )
+    for duplicate in duplicates:
+        intakes = Intake.objects.filter(
+            user_info_id=duplicate["user_info_id"], date=duplicate["date"]
+        ).order_by("id")
+        keep = intakes.first()
+        intakes.exclude(id=keep.id).delete()
+        keep.total_amount = duplicate["total"]
+        keep.save(update_fields=["total_amount"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("aquaholic", "0030_dispatchertick_status"),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_intakes, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name="intake",
+            constraint=models.UniqueConstraint(
+                fields=("user_info", "date"), name="unique_intake_user_date"
+            ),
+        ),
+    ]
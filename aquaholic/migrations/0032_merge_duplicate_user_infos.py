@@ -0,0 +1,47 @@
+# Generated by Django 4.1 on 2026-10-18 12:48
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def merge_duplicate_user_infos(apps, schema_editor):
+    """Keep the oldest user info of each user, moving the intakes of the others to it.
+
+    The schedules and outbox messages of the removed user infos are deleted
+    with them, the kept user info's schedule is the one in use.
+    """
+    UserInfo = apps.get_model("aquaholic", "UserInfo")
+    Intake = apps.get_model("aquaholic", "Intake")
+    duplicates = (
+        UserInfo.objects.exclude(user__isnull=True)
+        .values("user_id")
+        .annotate(rows=Count("id"))
+        .filter(rows__gt=1)
+    )
+    for duplicate in duplicates:
+        user_infos = UserInfo.objects.filter(user_id=duplicate["user_id"]).order_by(
+            "id"
+        )
+        keep = user_infos.first()
+        for intake in Intake.objects.filter(
+            user_info__in=user_infos.exclude(id=keep.id)
+        ):
+            kept = Intake.objects.filter(user_info_id=keep.id, date=intake.date)
+            if kept.exists():
+                kept.update(total_amount=models.F("total_amount") + intake.total_amount)
+                intake.delete()
+            else:
+                intake.user_info_id = keep.id
+                intake.save(update_fields=["user_info"])
+        user_infos.exclude(id=keep.id).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("aquaholic", "0031_intake_unique_user_date"),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_user_infos, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 4.1 on 2026-10-18 12:48
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ("aquaholic", "0032_merge_duplicate_user_infos"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="userinfo",
+            name="user",
+            field=models.OneToOneField(
+                null=True,
+                on_delete=django.db.models.deletion.CASCADE,
+                to=settings.AUTH_USER_MODEL,
+            ),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.1 on 2026-10-18 13:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("aquaholic", "0033_userinfo_user_one_to_one"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="outboxmessage",
+            name="first_scheduled_time",
+            field=models.DateTimeField(null=True, verbose_name="first scheduled time"),
+        ),
+    ]
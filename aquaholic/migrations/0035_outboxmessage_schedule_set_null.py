@@ -0,0 +1,23 @@
+# Generated by Django 4.1 on 2026-10-18 13:09
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("aquaholic", "0034_outboxmessage_first_scheduled_time"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="outboxmessage",
+            name="schedule",
+            field=models.ForeignKey(
+                null=True,
+                on_delete=django.db.models.deletion.SET_NULL,
+                to="aquaholic.schedule",
+            ),
+        ),
+    ]
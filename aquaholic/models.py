@@ -1,7 +1,7 @@
 """Models for Aquaholic application."""
 import datetime
 
-from django.db import models
+from django.db import IntegrityError, models, transaction
 from django.utils import timezone
 from django.contrib.auth.models import User
 
@@ -12,7 +12,7 @@ OUNCES_TO_MILLILITER = 29.5735296
 class UserInfo(models.Model):
     """UserInfo class for collect user information."""
 
-    user = models.ForeignKey(User, on_delete=models.CASCADE, null=True)
+    user = models.OneToOneField(User, on_delete=models.CASCADE, null=True)
     weight = models.FloatField(default=0)
     exercise_duration = models.FloatField(default=0)
     water_amount_per_day = models.IntegerField(default=0)
@@ -23,19 +23,85 @@ class UserInfo(models.Model):
     total_hours = models.FloatField(null=True)
     water_amount_per_hour = models.IntegerField(null=True)
     notify_token = models.CharField(max_length=200, null=True)
+    notify_token_valid = models.BooleanField(default=False)
+    notify_token_checked_time = models.DateTimeField('notify token checked time', null=True)
+    notify_auth_failures = models.IntegerField(default=0)
     time_interval = models.IntegerField(default=1)
+    notification_count = models.IntegerField(default=0)
     notification_turned_on = models.BooleanField(default=True)
 
+    @classmethod
+    def for_user(cls, user):
+        """Return the user info of user, creating it on first use.
+
+        The lookup is a point read on the unique user column, one query when
+        the user info exists already.
+        """
+        return cls.objects.get_or_create(user_id=user.id)[0]
+
     def set_water_amount_per_day(self):
         """Calculate amount of water per day."""
         self.water_amount_per_day = int(((self.weight * KILOGRAM_TO_POUND * 0.5) +
                                          (self.exercise_duration / 30) * 12) * OUNCES_TO_MILLILITER)
 
+    def set_notification_count(self):
+        """Calculate number of notifications per day."""
+        if self.total_hours is not None:
+            self.notification_count = int(self.total_hours/self.time_interval) + 1  # include last
+
     def set_water_amount_per_hour(self):
         """Calculate amount of water per hour."""
         if self.total_hours is not None:
-            num_notifications = int(self.total_hours/self.time_interval) + 1  # include last
-            self.water_amount_per_hour = int(self.water_amount_per_day / num_notifications)
+            self.set_notification_count()
+            self.water_amount_per_hour = int(self.water_amount_per_day / self.notification_count)
+
+    def update_goal(self):
+        """Recalculate the daily goal from weight and exercise and save it.
+
+        The new hourly amount is pushed to every schedule of the user with a
+        single UPDATE in the same transaction, and only when it has changed.
+        """
+        old_amount = self.water_amount_per_hour
+        self.set_water_amount_per_day()
+        self.set_water_amount_per_hour()
+        with transaction.atomic():
+            self.save()
+            if self.water_amount_per_hour is not None and self.water_amount_per_hour != old_amount:
+                Schedule.objects.filter(user_info_id=self.id).update(expected_amount=self.water_amount_per_hour)
+
+    def set_notification_turned_on(self, turned_on, now):
+        """Turn the user's notification on or off.
+
+        Turning off marks every schedule as done, turning on marks only the
+        past ones as done. Both are a single conditional UPDATE.
+        """
+        self.notification_turned_on = turned_on
+        status = models.Case(models.When(notification_time__lt=now, then=models.Value(True)),
+                             default=models.Value(False)) if turned_on else models.Value(True)
+        with transaction.atomic():
+            UserInfo.objects.filter(id=self.id).update(notification_turned_on=turned_on)
+            Schedule.objects.filter(user_info_id=self.id).update(notification_status=status)
+
+    def notification_times(self, now):
+        """Return the notification times of the day that is not over yet at now.
+
+        The schedule rule is the first notification time, the time interval
+        and the number of notifications. When the last notification of today
+        has passed, the times of tomorrow are returned. The user's Schedule
+        rows are generated from these times.
+        """
+        if not self.notification_count:
+            return []
+        first = timezone.make_aware(datetime.datetime.combine(timezone.localdate(now),
+                                                              self.first_notification_time))
+        interval = datetime.timedelta(hours=self.time_interval)
+        if first + interval * (self.notification_count - 1) < now:
+            first += datetime.timedelta(hours=24)
+        return [first + interval * i for i in range(self.notification_count)]
+
+    def reminders(self):
+        """Return the user's schedules in time order, with the delivery state the dispatcher keeps."""
+        return Schedule.objects.filter(user_info_id=self.id).order_by('notification_time')
 
 
 class Schedule(models.Model):
@@ -47,6 +113,12 @@ class Schedule(models.Model):
     notification_status = models.BooleanField(default=True)
     is_last = models.BooleanField(default=False)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['notification_status', 'notification_time'], name='schedule_status_time_idx'),
+            models.Index(fields=['notification_time', 'user_info'], name='schedule_time_user_idx'),
+        ]
+
 
 class Intake(models.Model):
     """Intake class for collect water intake of user per day."""
@@ -54,3 +126,123 @@ class Intake(models.Model):
     user_info = models.ForeignKey(UserInfo, on_delete=models.CASCADE, null=True)
     total_amount = models.FloatField(default=0)
     date = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user_info', 'date'], name='unique_intake_user_date'),
+        ]
+
+    @classmethod
+    def add(cls, user_info_id, date, amount):
+        """Add amount to the user's intake of date, creating the intake when there is none.
+
+        The common case is a single UPDATE. When two writers create the same
+        intake at once, the loser's INSERT hits the unique constraint and it
+        adds its amount to the winner's row instead.
+        """
+        intake = cls.objects.filter(user_info_id=user_info_id, date=date)
+        if intake.update(total_amount=models.F('total_amount') + amount):
+            return
+        try:
+            with transaction.atomic():
+                cls.objects.create(user_info_id=user_info_id, date=date, total_amount=amount)
+        except IntegrityError:
+            intake.update(total_amount=models.F('total_amount') + amount)
+
+
+class OutboxMessage(models.Model):
+    """OutboxMessage class for a queued delivery of one scheduled notification."""
+
+    PENDING = 'pending'
+    SENT = 'sent'
+    DEAD = 'dead'
+    SKIPPED = 'skipped'
+    STATUS_CHOICES = [(PENDING, 'Pending'), (SENT, 'Sent'), (DEAD, 'Dead'), (SKIPPED, 'Skipped')]
+
+    # kept when the user's schedule is regenerated, for in-flight deliveries and the delivery history
+    schedule = models.ForeignKey(Schedule, on_delete=models.SET_NULL, null=True)
+    user_info = models.ForeignKey(UserInfo, on_delete=models.CASCADE)
+    scheduled_time = models.DateTimeField('scheduled time')
+    # the earliest reminder coalesced into this message, lag is measured from it
+    first_scheduled_time = models.DateTimeField('first scheduled time', null=True)
+    expected_amount = models.IntegerField(default=0)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING)
+    attempts = models.IntegerField(default=0)
+    next_attempt_time = models.DateTimeField('next attempt time', default=timezone.now)
+    last_error = models.CharField(max_length=200, blank=True, default='')
+    response_status = models.IntegerField(null=True)
+    sent_time = models.DateTimeField('sent time', null=True)
+    claimed_by = models.CharField(max_length=100, blank=True, default='')
+    lease_until = models.DateTimeField('lease until', null=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['schedule', 'scheduled_time'], name='unique_outbox_schedule_time'),
+        ]
+        indexes = [
+            models.Index(fields=['status', 'next_attempt_time'], name='outbox_status_next_idx'),
+        ]
+
+
+class DispatcherLock(models.Model):
+    """DispatcherLock class for a named lock held by one dispatcher tick at a time."""
+
+    name = models.CharField(max_length=50, unique=True)
+    holder = models.CharField(max_length=100, blank=True, default='')
+    lease_until = models.DateTimeField('lease until', null=True)
+
+    def __str__(self):
+        return f"{self.name} held by {self.holder or 'nobody'}"
+
+
+class DispatcherCounter(models.Model):
+    """DispatcherCounter class for a running total kept by the dispatcher."""
+
+    TOKENS_PRUNED = 'tokens_pruned'
+
+    name = models.CharField(max_length=50, unique=True)
+    value = models.BigIntegerField(default=0)
+
+    @classmethod
+    def increment(cls, name, amount=1):
+        """Add amount to the counter called name."""
+        cls.objects.get_or_create(name=name)
+        cls.objects.filter(name=name).update(value=models.F('value') + amount)
+
+    @classmethod
+    def get_value(cls, name):
+        """Return the value of the counter called name, 0 if it was never incremented."""
+        return cls.objects.filter(name=name).values_list('value', flat=True).first() or 0
+
+    def __str__(self):
+        return f"{self.name} = {self.value}"
+
+
+class DispatcherTick(models.Model):
+    """DispatcherTick class for the progress and statistics of one notification tick (times in seconds)."""
+
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    SKIPPED = 'skipped'
+    FAILED = 'failed'
+    STATUS_CHOICES = [(QUEUED, 'Queued'), (RUNNING, 'Running'), (DONE, 'Done'), (SKIPPED, 'Skipped'),
+                      (FAILED, 'Failed')]
+
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=DONE)
+    started_time = models.DateTimeField('started time', db_index=True)
+    finished_time = models.DateTimeField('finished time', null=True)
+    duration = models.FloatField(default=0)
+    due = models.IntegerField(default=0)
+    sent = models.IntegerField(default=0)
+    failed = models.IntegerField(default=0)
+    skipped = models.IntegerField(default=0)
+    deferred = models.IntegerField(default=0)
+    backlog = models.IntegerField(default=0)
+    max_lag = models.FloatField(default=0)
+    latency_p50 = models.FloatField(null=True)
+    latency_p95 = models.FloatField(null=True)
+    latency_p99 = models.FloatField(null=True)
+
+    def __str__(self):
+        return f"tick at {self.started_time}: {self.sent} sent, {self.failed} failed"
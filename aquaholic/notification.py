@@ -1,11 +1,129 @@
 """A module that keep methods related to line notification."""
+import logging
+import threading
+import time
+from collections import namedtuple
+
 import requests
 from decouple import config
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+logger = logging.getLogger(__name__)
+
+# reset is the epoch second at which LINE restores the remaining calls
+RateLimit = namedtuple('RateLimit', ['limit', 'remaining', 'reset'])
+NotifyResult = namedtuple('NotifyResult', ['status', 'rate_limit'])
+
+
+class NotificationUnavailable(requests.RequestException):
+    """Raised instead of calling LINE while the circuit breaker is open."""
+
+
+class CircuitBreaker:
+    """Fail fast after too many LINE failures in a row.
+
+    Once failure_threshold consecutive calls have failed, every call is
+    refused for reset_timeout seconds. After that a single call is let
+    through as a probe, its outcome closes or re-opens the breaker.
+    """
+
+    def __init__(self, failure_threshold, reset_timeout):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        """Raise NotificationUnavailable if the call must not be made."""
+        with self._lock:
+            if self.opened_at is None:
+                return
+            if time.monotonic() - self.opened_at < self.reset_timeout:
+                raise NotificationUnavailable("LINE API circuit breaker is open")
+            # half open, restart the timer so only this call goes through
+            self.opened_at = time.monotonic()
+
+    def record_success(self):
+        """Close the breaker."""
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        """Count a failure and open the breaker when the threshold is reached."""
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+
+
+class LineClient:
+    """A pooled HTTP client shared by every call to the LINE APIs.
+
+    Connections are kept alive in a requests Session, every call has a
+    connect and a read timeout, connection errors and 5xx answers are
+    retried with exponential backoff, and a circuit breaker stops calling
+    LINE while it is down. The latency of every call is logged.
+    """
+
+    def __init__(self, pool_size, connect_timeout, read_timeout, retries, backoff_factor,
+                 failure_threshold, reset_timeout):
+        # read errors are not retried, LINE may already have delivered the message
+        retry = Retry(total=retries, connect=retries, read=0, status=retries,
+                      backoff_factor=backoff_factor, status_forcelist=(500, 502, 503, 504),
+                      allowed_methods=None, raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.timeout = (connect_timeout, read_timeout)
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+
+    def request(self, method, url, **kwargs):
+        """Call LINE and return the response, raise requests.RequestException on failure."""
+        self.breaker.before_call()
+        start = time.perf_counter()
+        try:
+            response = self.session.request(method, url, timeout=self.timeout, **kwargs)
+        except requests.RequestException as error:
+            self.breaker.record_failure()
+            logger.warning("LINE %s %s failed after %.1f ms: %s",
+                           method, url, (time.perf_counter() - start) * 1000, error)
+            raise
+        if response.status_code >= 500:
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+        logger.debug("LINE %s %s returned %s in %.1f ms",
+                     method, url, response.status_code, (time.perf_counter() - start) * 1000)
+        return response
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """Return the LineClient of this process, creating it on first use."""
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = LineClient(pool_size=settings.NOTIFICATION_WORKERS,
+                                 connect_timeout=settings.LINE_CONNECT_TIMEOUT,
+                                 read_timeout=settings.LINE_READ_TIMEOUT,
+                                 retries=settings.LINE_RETRIES,
+                                 backoff_factor=settings.LINE_RETRY_BACKOFF,
+                                 failure_threshold=settings.LINE_BREAKER_THRESHOLD,
+                                 reset_timeout=settings.LINE_BREAKER_RESET)
+        return _client
 
 
 def get_access_token(code):
     """Generate access token from the given code."""
-    api_url = "https://notify-bot.line.me/oauth/token"
+    api_url = f"{settings.LINE_NOTIFY_BOT_URL}/oauth/token"
     content_type = "application/x-www-form-urlencoded"
 
     grant_type = "authorization_code"
@@ -20,28 +138,50 @@ def get_access_token(code):
         "client_id": client_id,
         "client_secret": client_secret
     }
-    response = requests.post(api_url, headers=headers, data=data)
-    return response.json()['access_token']
+    response = get_client().request('POST', api_url, headers=headers, data=data)
+    return response.json().get('access_token')
 
 
-def send_notification(message, token):
-    """Send notification from message anf token provided."""
-    url = 'https://notify-api.line.me/api/notify'
-    if not token:
+def parse_rate_limit(headers):
+    """Read LINE's X-RateLimit-* headers, return None when there are none."""
+    values = []
+    for name in ('X-RateLimit-Limit', 'X-RateLimit-Remaining', 'X-RateLimit-Reset'):
+        try:
+            values.append(int(headers[name]))
+        except (KeyError, ValueError):
+            values.append(None)
+    if values == [None, None, None]:
         return None
+    return RateLimit(*values)
+
+
+def notify(message, token):
+    """Send notification and return a NotifyResult with LINE's rate limit."""
+    url = f"{settings.LINE_NOTIFY_API_URL}/api/notify"
+    if not token:
+        return NotifyResult(None, None)
     headers = {'content-type': 'application/x-www-form-urlencoded',
                'Authorization': 'Bearer ' + token}
 
-    response = requests.post(url, headers=headers, data={'message': message})
-    return response.json()['status']
+    response = get_client().request('POST', url, headers=headers, data={'message': message})
+    return NotifyResult(response.status_code, parse_rate_limit(response.headers))
+
+
+def send_notification(message, token):
+    """Send notification from message anf token provided."""
+    return notify(message, token).status
 
 
 def check_token_status(token):
-    """Check the token status (200 == valid)."""
-    url = "https://notify-api.line.me/api/status"
+    """Check the token status (200 == valid).
+
+    The HTTP status is returned rather than the status in the body, so an
+    error page without a JSON body is an answer like any other.
+    """
+    url = f"{settings.LINE_NOTIFY_API_URL}/api/status"
     if not token:
         return 0
     headers = {'content-type': 'application/x-www-form-urlencoded',
                'Authorization': 'Bearer ' + token}
-    response = requests.get(url, headers=headers)
-    return response.json()['status']
+    response = get_client().request('GET', url, headers=headers)
+    return response.status_code
@@ -0,0 +1,308 @@
+"""A module that keeps the durable outbox of LINE notifications.
+
+Due schedules are first turned into OutboxMessage rows, then the outbox is
+drained in batches. A failed send is retried with exponential backoff and
+dead-lettered after settings.NOTIFICATION_MAX_ATTEMPTS attempts.
+
+Several dispatchers, on one or more hosts, can drain the same outbox: each
+batch is claimed with a lease first, so a message is only sent by the worker
+holding its lease. A lease left behind by a crashed worker expires after
+settings.NOTIFICATION_LEASE_SECONDS and the message is claimed again.
+"""
+import logging
+import math
+import os
+import socket
+import time
+import uuid
+from collections import defaultdict
+from itertools import groupby
+from operator import itemgetter
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import F, Q, Sum
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from .dispatcher import chunked, reminder_message, send_all
+from .models import DispatcherCounter, Intake, OutboxMessage, Schedule, UserInfo
+from .throttle import SendDeferred
+
+logger = logging.getLogger(__name__)
+
+
+def due_chunks(now, size=None):
+    """Yield the due schedules of users with a valid LINE token as lists of at most size rows.
+
+    Only the columns the outbox needs are read, with the user joined in, and
+    the rows are paged with a (user_info_id, id) keyset, so memory stays the
+    same however large the backlog is. Each user's rows come in order, one
+    user after the other. Schedules of users without a valid token are not
+    read at all, the rollover moves them on (see
+    aquaholic.cron.rollover_schedules).
+    """
+    size = size or settings.NOTIFICATION_BATCH_SIZE
+    due = (Schedule.objects.filter(notification_time__lte=now, notification_status=False,
+                                   user_info__notify_token_valid=True)
+           .order_by('user_info_id', 'id'))
+    page = due
+    while True:
+        rows = list(page.values_list('id', 'user_info_id', 'notification_time', 'expected_amount')[:size])
+        if rows:
+            yield rows
+        if len(rows) < size:
+            return
+        last_id, last_user_info_id = rows[-1][0], rows[-1][1]
+        page = due.filter(Q(user_info_id__gt=last_user_info_id) | Q(user_info_id=last_user_info_id, id__gt=last_id))
+
+
+def coalesce(rows, now):
+    """Turn due schedule rows, grouped by user, into at most one outbox message per user.
+
+    After an outage a user can have several overdue reminders. They are
+    collapsed into one message for the latest reminder, asking for the sum
+    of their amounts. Reminders older than settings.NOTIFICATION_STALE_AFTER
+    seconds are left out (0 keeps them all).
+    """
+    stale_before = now - timezone.timedelta(seconds=settings.NOTIFICATION_STALE_AFTER) \
+        if settings.NOTIFICATION_STALE_AFTER else None
+    for user_info_id, user_rows in groupby(rows, key=itemgetter(1)):
+        fresh = [(notification_time, schedule_id, expected_amount)
+                 for schedule_id, _, notification_time, expected_amount in user_rows
+                 if stale_before is None or notification_time >= stale_before]
+        if fresh:
+            notification_time, schedule_id, _ = max(fresh)
+            yield OutboxMessage(schedule_id=schedule_id, user_info_id=user_info_id, scheduled_time=notification_time,
+                                first_scheduled_time=min(fresh)[0],
+                                expected_amount=sum(amount for _, _, amount in fresh), next_attempt_time=now)
+
+
+def enqueue_due_schedules(now):
+    """Copy the due schedules of users with a valid LINE token into the outbox and mark them as handled.
+
+    Runs in one transaction. Each user gets a single message however many
+    reminders are due (see coalesce), the others are skipped. The unique
+    (schedule, scheduled_time) constraint makes enqueueing the same
+    notification twice a no-op. Most users share the same reminder times,
+    so schedules are marked handled with one UPDATE per distinct slot time
+    rather than by id.
+    Return the number of schedules handled and the number of messages
+    enqueued for them, the difference is the reminders skipped.
+    """
+    slots = set()
+
+    def collect_slots(chunks):
+        for rows in chunks:
+            slots.update(row[2] for row in rows)
+            yield from rows
+
+    enqueued = 0
+    handled = 0
+    with transaction.atomic():
+        for messages in chunked(coalesce(collect_slots(due_chunks(now)), now)):
+            OutboxMessage.objects.bulk_create(messages, ignore_conflicts=True)
+            enqueued += len(messages)
+        for slot in sorted(slots):
+            handled += Schedule.objects.filter(notification_time=slot, notification_status=False,
+                                               user_info__notify_token_valid=True
+                                               ).update(notification_status=True)
+        # schedules left without a user are never sent
+        handled += Schedule.objects.filter(notification_time__lte=now, notification_status=False,
+                                           user_info__isnull=True).update(notification_status=True)
+    if handled > enqueued:
+        logger.info("Skipped %d overdue or stale reminders", handled - enqueued)
+    return handled, enqueued
+
+
+def retry_delay(attempts):
+    """Return the backoff before the next attempt after attempts failures."""
+    return timezone.timedelta(seconds=settings.NOTIFICATION_RETRY_DELAY * 2 ** (attempts - 1))
+
+
+def apply_results(batch, results, now):
+    """Write the outcome of one batch of sends back to the outbox in bulk.
+
+    batch holds (id, attempts) of each message, results the SendResult
+    of each send. Answered messages are marked sent, deferred ones are left
+    alone and failed ones are rescheduled or dead-lettered.
+    """
+    attempts = dict(batch)
+    sent = defaultdict(list)
+    failed = defaultdict(list)
+    for result in results:
+        if result.error is None:
+            sent[result.status].append(result.job_id)
+        elif not isinstance(result.error, SendDeferred):
+            tries = attempts[result.job_id] + 1
+            failed[(tries, str(result.error)[:200])].append(result.job_id)
+    for status, ids in sent.items():
+        OutboxMessage.objects.filter(id__in=ids).update(status=OutboxMessage.SENT, response_status=status,
+                                                        attempts=F('attempts') + 1, sent_time=now)
+    for (tries, error), ids in failed.items():
+        if tries >= settings.NOTIFICATION_MAX_ATTEMPTS:
+            OutboxMessage.objects.filter(id__in=ids).update(status=OutboxMessage.DEAD, attempts=tries,
+                                                            last_error=error)
+        else:
+            OutboxMessage.objects.filter(id__in=ids).update(attempts=tries, last_error=error,
+                                                            next_attempt_time=now + retry_delay(tries))
+
+
+def prune_revoked_tokens(user_info_ids, results):
+    """Count LINE's 401 answers per user and invalidate tokens that keep failing.
+
+    user_info_ids maps each message id to its user. A user whose token was
+    refused settings.NOTIFICATION_AUTH_FAILURE_LIMIT times in a row gets
+    notify_token_valid=False, and their pending messages are dead-lettered.
+    Return the number of tokens invalidated.
+    """
+    refused = {user_info_ids[result.job_id] for result in results if result.status == 401}
+    accepted = {user_info_ids[result.job_id] for result in results if result.status == 200} - refused
+    for ids in chunked(accepted):
+        UserInfo.objects.filter(id__in=ids, notify_auth_failures__gt=0).update(notify_auth_failures=0)
+    pruned = 0
+    for ids in chunked(refused):
+        UserInfo.objects.filter(id__in=ids).update(notify_auth_failures=F('notify_auth_failures') + 1)
+        revoked = UserInfo.objects.filter(id__in=ids, notify_token_valid=True,
+                                          notify_auth_failures__gte=settings.NOTIFICATION_AUTH_FAILURE_LIMIT)
+        revoked_ids = list(revoked.values_list('id', flat=True))
+        if revoked_ids:
+            UserInfo.objects.filter(id__in=revoked_ids).update(notify_token_valid=False)
+            OutboxMessage.objects.filter(user_info_id__in=revoked_ids, status=OutboxMessage.PENDING).update(
+                status=OutboxMessage.DEAD, last_error="LINE token revoked")
+            pruned += len(revoked_ids)
+    if pruned:
+        DispatcherCounter.increment(DispatcherCounter.TOKENS_PRUNED, pruned)
+    return pruned
+
+
+def worker_name():
+    """Return a name that tells this dispatcher apart from every other one."""
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+def claimable(now):
+    """Return the pending messages that are due and not leased by a live worker."""
+    return OutboxMessage.objects.filter(Q(lease_until__isnull=True) | Q(lease_until__lt=now),
+                                        status=OutboxMessage.PENDING, next_attempt_time__lte=now)
+
+
+def claim_batch(worker, now, last_id=0, batch_size=None, clock=None):
+    """Lease up to batch_size due messages with an id above last_id to worker.
+
+    Messages due at now are claimed. The lease runs from the time of the
+    claim, read from clock (timezone.now by default), so batches claimed
+    late in a long drain are not leased already expired.
+
+    Where the database supports it the candidate rows are locked with
+    SELECT ... FOR UPDATE SKIP LOCKED, so concurrent workers pick disjoint
+    rows. Elsewhere (SQLite) the lease is a compare-and-set UPDATE that only
+    matches rows still claimable, and a worker keeps only the rows it won.
+    Return the ids of the claimed messages in id order, empty once nothing
+    is left to claim.
+    """
+    batch_size = batch_size or settings.NOTIFICATION_BATCH_SIZE
+    clock = clock or timezone.now
+    lease_until = max(now, clock()) + timezone.timedelta(seconds=settings.NOTIFICATION_LEASE_SECONDS)
+    while True:
+        candidates = claimable(now).filter(id__gt=last_id).order_by('id')
+        with transaction.atomic():
+            if connection.features.has_select_for_update_skip_locked:
+                candidates = candidates.select_for_update(skip_locked=True)
+            ids = list(candidates.values_list('id', flat=True)[:batch_size])
+            if not ids:
+                return []
+            claimable(now).filter(id__in=ids).update(claimed_by=worker, lease_until=lease_until)
+        claimed = list(OutboxMessage.objects.filter(id__in=ids, claimed_by=worker, lease_until=lease_until)
+                       .order_by('id').values_list('id', flat=True))
+        if claimed:
+            return claimed
+        # another worker won every candidate, they are leased now so the next round skips them
+
+
+def release(worker, ids):
+    """Give up the leases worker holds on ids."""
+    OutboxMessage.objects.filter(id__in=ids, claimed_by=worker).update(claimed_by='', lease_until=None)
+
+
+def day_totals(user_info_ids, now):
+    """Return how much water each user has drunk on the local day of now, in one aggregated query."""
+    return dict(Intake.objects.filter(user_info_id__in=user_info_ids, date__date=timezone.localdate(now))
+                .values('user_info_id').annotate(total=Sum('total_amount')).values_list('user_info_id', 'total'))
+
+
+def fit_to_goal(batch, now):
+    """Return the send jobs for batch and the ids of messages no longer needed.
+
+    A user who already drank their daily goal is not reminded, and a user
+    close to it is only asked for what is missing.
+    """
+    totals = day_totals({message['user_info_id'] for message in batch}, now)
+    jobs = []
+    met_goal = []
+    # users of the same slot mostly get the same amount, render each message once
+    rendered = {}
+    for message in batch:
+        amount = message['expected_amount']
+        if message['goal']:
+            remaining = message['goal'] - totals.get(message['user_info_id'], 0)
+            if remaining <= 0:
+                met_goal.append(message['id'])
+                continue
+            amount = min(amount, math.ceil(remaining))
+        if amount not in rendered:
+            rendered[amount] = reminder_message(amount)
+        jobs.append((message['id'], rendered[amount], message['token']))
+    return jobs, met_goal
+
+
+def drain_outbox(now, batch_size=None, worker=None, deadline=None, stats=None, clock=None):
+    """Send every pending message whose next attempt time has come.
+
+    Messages are claimed in batches ordered by id, so a message deferred in
+    this tick is not picked up again before the next one, and messages
+    leased by another worker are skipped. Messages to users who already met
+    today's goal are skipped as well. No new batch is claimed once the
+    time.monotonic() deadline has passed. The outcome of every batch is
+    added to stats when a TickStats is given, with lags measured by clock
+    (timezone.now by default).
+    Return the number of messages attempted.
+    """
+    batch_size = batch_size or settings.NOTIFICATION_BATCH_SIZE
+    worker = worker or worker_name()
+    clock = clock or timezone.now
+    last_id = 0
+    attempted = 0
+    while deadline is None or time.monotonic() < deadline:
+        ids = claim_batch(worker, now, last_id, batch_size, clock)
+        if not ids:
+            break
+        batch = list(OutboxMessage.objects.filter(id__in=ids).order_by('id')
+                     .values('id', 'attempts', 'expected_amount', 'user_info_id',
+                             lag_from=Coalesce('first_scheduled_time', 'scheduled_time'),
+                             token=F('user_info__notify_token'), goal=F('user_info__water_amount_per_day')))
+        jobs, met_goal = fit_to_goal(batch, now)
+        OutboxMessage.objects.filter(id__in=met_goal).update(status=OutboxMessage.SKIPPED, sent_time=now)
+        results = send_all(jobs)
+        if stats is not None:
+            stats.skipped += len(met_goal)
+            stats.record_sends(results, {message['id']: message['lag_from'] for message in batch},
+                               clock())
+        apply_results([(message['id'], message['attempts']) for message in batch], results, now)
+        prune_revoked_tokens({message['id']: message['user_info_id'] for message in batch}, results)
+        release(worker, ids)
+        attempted += len(batch)
+        last_id = ids[-1]
+    return attempted
+
+
+def backlog(now):
+    """Return the number of due messages still waiting to be sent."""
+    return claimable(now).count()
+
+
+def purge_outbox(now):
+    """Delete sent and skipped messages older than settings.NOTIFICATION_OUTBOX_RETENTION days."""
+    OutboxMessage.objects.filter(status__in=[OutboxMessage.SENT, OutboxMessage.SKIPPED],
+                                 sent_time__lt=now - timezone.timedelta(days=settings.NOTIFICATION_OUTBOX_RETENTION)
+                                 ).delete()
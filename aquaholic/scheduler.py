@@ -0,0 +1,55 @@
+"""A module that knows when the next notification is due, for the dispatcher daemon."""
+import heapq
+import math
+
+from django.utils import timezone
+
+from .models import OutboxMessage, Schedule
+
+
+class DueQueue:
+    """A min-heap of the distinct epoch seconds at which notifications are due.
+
+    Only the notifications due within horizon seconds are loaded, and many
+    users sharing the same reminder time take a single entry, so the heap
+    stays small however many users there are.
+    """
+
+    def __init__(self, horizon):
+        self.horizon = horizon
+        self.heap = []
+
+    def load(self, now, last_tick=None, retry_interval=60):
+        """Reload the heap with everything due up to now + horizon.
+
+        Entries that were already due at last_tick were left over by that
+        tick (rate limited, for example), they are moved to last_tick +
+        retry_interval so the daemon does not spin on them.
+        """
+        until = now + timezone.timedelta(seconds=self.horizon)
+        schedule_times = (Schedule.objects.filter(notification_status=False, notification_time__lte=until,
+                                                  user_info__notify_token_valid=True)
+                          .values_list('notification_time', flat=True).distinct())
+        retry_times = (OutboxMessage.objects.filter(status=OutboxMessage.PENDING, next_attempt_time__lte=until)
+                       .values_list('next_attempt_time', flat=True).distinct())
+        seconds = {math.ceil(due_time.timestamp()) for due_time in schedule_times}
+        seconds.update(math.ceil(due_time.timestamp()) for due_time in retry_times)
+        if last_tick is not None:
+            left_over = int(last_tick.timestamp())
+            seconds = {second if second > left_over else left_over + retry_interval for second in seconds}
+        self.heap = list(seconds)
+        heapq.heapify(self.heap)
+
+    def next_due(self):
+        """Return the epoch second of the next due entry, None if nothing is due."""
+        return self.heap[0] if self.heap else None
+
+    def pop_due(self, now):
+        """Remove and return every entry due at now."""
+        due = []
+        while self.heap and self.heap[0] <= now.timestamp():
+            due.append(heapq.heappop(self.heap))
+        return due
+
+    def __len__(self):
+        return len(self.heap)
@@ -0,0 +1,146 @@
+"""A module that replays days of dispatcher ticks against a virtual clock.
+
+The simulator seeds users through the same code the set up page uses, then
+runs aquaholic.cron.update_notification the way crontab would, every
+tick_minutes, with the LINE sender replaced by a recorder. Minutes in which
+nothing is due are skipped, so thirty simulated days take seconds.
+"""
+import datetime
+import math
+import threading
+from collections import Counter
+from unittest.mock import patch
+
+from django.db import connection
+from django.db.models import Min
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.utils import timezone
+
+from . import dispatcher
+from .cron import update_notification
+from .models import OutboxMessage, Schedule, UserInfo
+from .notification import NotifyResult
+from .views import SetUpView
+
+WRITE_STATEMENTS = ('INSERT', 'UPDATE', 'DELETE')
+
+
+def random_user_info(rng, number):
+    """Return an unsaved UserInfo with realistic reminder settings and a valid token."""
+    user_info = UserInfo(weight=rng.randint(40, 110), exercise_duration=rng.choice((0, 0, 30, 60, 90)),
+                         first_notification_time=datetime.time(rng.choice((7, 8, 8, 8, 9)), 0),
+                         last_notification_time=datetime.time(rng.choice((21, 22, 22, 22, 23)), 0),
+                         time_interval=rng.choice((1, 1, 1, 2, 3)), notify_token=f"token-{number}",
+                         notify_token_valid=True)
+    user_info.total_hours = user_info.last_notification_time.hour - user_info.first_notification_time.hour
+    user_info.set_water_amount_per_day()
+    user_info.set_water_amount_per_hour()
+    return user_info
+
+
+class VirtualClock:
+    """A clock that only moves when told to, called like timezone.now."""
+
+    def __init__(self, start):
+        self.now = start
+
+    def __call__(self):
+        return self.now
+
+    def advance_to(self, moment):
+        """Move the clock forward to moment."""
+        self.now = max(self.now, moment)
+
+
+class SendRecorder:
+    """Stand-in for aquaholic.notification.notify that records every send and answers 200."""
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.sends = Counter()
+        self.lock = threading.Lock()
+
+    def __call__(self, message, token):
+        with self.lock:
+            self.sends[(token, self.clock())] += 1
+        return NotifyResult(200, None)
+
+
+class Simulation:
+    """Replay days of dispatcher ticks over a seeded population."""
+
+    def __init__(self, users, days, start, rng, tick_minutes=1):
+        self.users = users
+        self.days = days
+        self.start = start.replace(second=0, microsecond=0)
+        self.rng = rng
+        self.tick = datetime.timedelta(minutes=tick_minutes)
+        self.clock = VirtualClock(self.start)
+        self.recorder = SendRecorder(self.clock)
+        self.last_tick = None
+
+    def seed(self):
+        """Create the users and their schedules as the set up page would at the start time."""
+        user_infos = UserInfo.objects.bulk_create(random_user_info(self.rng, number) for number in range(self.users))
+        for user_info in user_infos:
+            SetUpView.create_schedule(user_info, now=self.start)
+
+    def next_tick(self):
+        """Return the first cron tick after the current time at which something is due, None if nothing is."""
+        candidates = [
+            Schedule.objects.filter(notification_status=False).aggregate(due=Min('notification_time'))['due'],
+            OutboxMessage.objects.filter(status=OutboxMessage.PENDING).aggregate(due=Min('next_attempt_time'))['due'],
+            Schedule.objects.filter(is_last=True, notification_time__gt=self.clock()
+                                    ).aggregate(due=Min('notification_time'))['due'],
+        ]
+        due = min((candidate for candidate in candidates if candidate is not None), default=None)
+        if due is None:
+            return None
+        ticks = max(math.ceil((due - self.start) / self.tick), 0)
+        tick_time = self.start + ticks * self.tick
+        if self.last_tick is not None and tick_time <= self.last_tick:
+            tick_time = self.last_tick + self.tick
+        return tick_time
+
+    def run(self):
+        """Run the simulation and return the report."""
+        end = self.start + datetime.timedelta(days=self.days)
+        sends_per_day = [0] * self.days
+        writes_per_day = [0] * self.days
+        schedule_rows = [0] * self.days
+        late_sends = 0
+        ticks = 0
+        with patch('aquaholic.dispatcher.notify', self.recorder), \
+                override_settings(NOTIFICATION_MAX_RATE=10 ** 9, NOTIFICATION_BURST=10 ** 6,
+                                  NOTIFICATION_TICK_BUDGET=10 ** 6):
+            # the throttle is built from the settings on first use
+            dispatcher._throttle = None
+            try:
+                while True:
+                    tick_time = self.next_tick()
+                    if tick_time is None or tick_time >= end:
+                        break
+                    self.clock.advance_to(tick_time)
+                    self.last_tick = tick_time
+                    day = (tick_time - self.start).days
+                    sent_before = sum(self.recorder.sends.values())
+                    with CaptureQueriesContext(connection) as queries:
+                        update_notification(clock=self.clock)
+                    ticks += 1
+                    sends_per_day[day] += sum(self.recorder.sends.values()) - sent_before
+                    writes_per_day[day] += sum(query['sql'].startswith(WRITE_STATEMENTS)
+                                               for query in queries.captured_queries)
+                    late_sends += OutboxMessage.objects.filter(status=OutboxMessage.SENT, sent_time=tick_time,
+                                                               scheduled_time__lt=tick_time - self.tick).count()
+                    schedule_rows[day] = Schedule.objects.count()
+            finally:
+                dispatcher._throttle = None
+        per_minute = Counter()
+        for (_, sent_time), count in self.recorder.sends.items():
+            per_minute[timezone.localtime(sent_time).strftime('%H:%M')] += count
+        return {'users': self.users, 'days': self.days, 'tick_minutes': self.tick.total_seconds() / 60,
+                'ticks': ticks, 'total_sends': sum(self.recorder.sends.values()), 'late_sends': late_sends,
+                'duplicate_sends': sum(count - 1 for count in self.recorder.sends.values() if count > 1),
+                'sends_per_day': sends_per_day, 'db_writes_per_day': writes_per_day,
+                'schedule_rows_per_day': schedule_rows,
+                'sends_per_minute_of_day': dict(sorted(per_minute.items()))}
@@ -1,14 +1,37 @@
 """Unittests for aquaholic app."""
+import contextlib
 import datetime
+import random
+import time
 from http import HTTPStatus
-from unittest.mock import patch
+from io import StringIO
+from unittest.mock import Mock, patch
+import requests
+from django.core.management import call_command
 from django.urls import reverse
-from django.test import TestCase
+from django.db import IntegrityError, connection, transaction
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.contrib.auth.models import User
 from django.utils import timezone
 from aquaholic.views import get_total_hours
-from aquaholic.models import UserInfo, Intake, Schedule
-from aquaholic.notification import get_access_token, send_notification, check_token_status
+from aquaholic.models import UserInfo, Intake, Schedule, OutboxMessage, DispatcherCounter, DispatcherLock, DispatcherTick
+from aquaholic.notification import (get_access_token, send_notification, check_token_status, LineClient,
+                                    NotificationUnavailable, NotifyResult, RateLimit, notify, parse_rate_limit)
+from aquaholic.cron import acquire_tick_lock, run_tick, start_tick, update_notification, rollover_schedules
+from aquaholic.dispatcher import SendResult, send_all
+from aquaholic.line_emulator import LineNotifyEmulator
+from aquaholic.metrics import TickStats, percentile
+from aquaholic.outbox import claim_batch, drain_outbox, due_chunks, enqueue_due_schedules, purge_outbox
+from aquaholic.scheduler import DueQueue
+from aquaholic.simulator import Simulation
+from aquaholic.throttle import SendDeferred, SendThrottle
+
+
+def run_ticks_inline():
+    """Patch the background tick runner so that queued ticks run before the cron view answers."""
+    return patch('aquaholic.cron.threading.Thread',
+                 side_effect=lambda target, args, daemon: Mock(start=lambda: target(*args)))
 
 
 def create_userinfo(weight, exercise_time, first_notification_time, last_notification_time):
@@ -47,6 +70,35 @@ class UserInfoModelTests(TestCase):
         user.set_water_amount_per_hour()
         self.assertAlmostEqual(int(per_hour), user.water_amount_per_hour, 2)
 
+    def test_for_user(self):
+        """The user info is created on first use, then read with one query, and only one per user exists."""
+        user = User.objects.create(username='profile')
+        user_info = UserInfo.for_user(user)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(user_info, UserInfo.for_user(user))
+        self.assertEqual(1, len(queries.captured_queries))
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            UserInfo.objects.create(user=user)
+
+    def test_update_goal_updates_schedule_in_one_query(self):
+        """A new goal reaches every schedule with one UPDATE, an unchanged goal does not touch them."""
+        user = create_userinfo(50, 60, first_notification_time=datetime.time(8, 0, 0),
+                               last_notification_time=datetime.time(22, 0, 0))
+        user.total_hours = get_total_hours(user.first_notification_time, user.last_notification_time)
+        user.update_goal()
+        for hour in range(3):
+            Schedule.objects.create(user_info=user, notification_time=timezone.now() + timezone.timedelta(hours=hour),
+                                    expected_amount=user.water_amount_per_hour)
+        user.weight = 70
+        with CaptureQueriesContext(connection) as queries:
+            user.update_goal()
+        updates = [query['sql'] for query in queries.captured_queries if query['sql'].startswith('UPDATE')]
+        self.assertEqual(2, len(updates))  # the user info and the schedule
+        self.assertEqual({user.water_amount_per_hour}, set(Schedule.objects.values_list('expected_amount', flat=True)))
+        with CaptureQueriesContext(connection) as queries:
+            user.update_goal()
+        self.assertFalse([query for query in queries.captured_queries if 'aquaholic_schedule' in query['sql']])
+
 
 class HomePageViewTests(TestCase):
     """Tests homepage view."""
@@ -292,6 +344,43 @@ class SetUpViewTests(TestCase):
                                           "notify_interval": 1})
         self.assertContains(response, "Please, enter time in both fields.", html=True)
 
+    def post_settings(self, first, last, interval):
+        """Save notification settings and return the SQL run by the request."""
+        with CaptureQueriesContext(connection) as queries:
+            self.client.post(reverse("aquaholic:set_up", args=(self.user.id,)),
+                             data={"first_notification": first, "last_notification": last, "notify_interval": interval})
+        return [query['sql'] for query in queries.captured_queries]
+
+    def test_schedule_is_regenerated_with_constant_queries(self):
+        """The schedule is rebuilt in one transaction with the same queries however many reminders it has."""
+        self.post_settings("08:00", "20:00", 3)
+        hourly = self.post_settings("08:00", "22:00", 1)
+        self.assertEqual(15, Schedule.objects.count())
+        every_three_hours = self.post_settings("08:00", "20:00", 3)
+        self.assertEqual(5, Schedule.objects.count())
+        self.assertEqual(len(hourly), len(every_three_hours))
+        self.assertEqual(1, sum(sql.startswith('INSERT INTO "aquaholic_schedule"') for sql in every_three_hours))
+
+    def test_unchanged_settings_keep_the_schedule(self):
+        """Saving the same settings again does not touch the schedule."""
+        self.post_settings("08:00", "20:00", 3)
+        schedule_ids = list(Schedule.objects.values_list('id', flat=True))
+        queries = self.post_settings("08:00", "20:00", 3)
+        self.assertEqual(schedule_ids, list(Schedule.objects.values_list('id', flat=True)))
+        self.assertFalse([sql for sql in queries if 'aquaholic_schedule' in sql and not sql.startswith('SELECT')])
+
+    def test_regenerating_keeps_the_outbox(self):
+        """Pending and sent outbox messages survive a schedule rebuild, they just lose their schedule."""
+        self.post_settings("08:00", "20:00", 3)
+        user_info = UserInfo.objects.get(user_id=self.user.id)
+        for schedule, status in zip(Schedule.objects.all()[:2], (OutboxMessage.PENDING, OutboxMessage.SENT)):
+            OutboxMessage.objects.create(schedule=schedule, user_info=user_info, status=status,
+                                         scheduled_time=schedule.notification_time)
+        self.post_settings("08:00", "22:00", 1)
+        self.assertEqual([None, None], list(OutboxMessage.objects.values_list('schedule_id', flat=True)))
+        self.assertEqual({OutboxMessage.PENDING, OutboxMessage.SENT},
+                         set(OutboxMessage.objects.values_list('status', flat=True)))
+
 
 class SetUpRegistrationViewTest(TestCase):
     """Test set up view for new user."""
@@ -313,6 +402,36 @@ class SetUpRegistrationViewTest(TestCase):
         self.assertTemplateUsed(response, "aquaholic/set_up_regist.html")
 
 
+class ScheduleRuleTests(TestCase):
+    """Tests for computing notification times from the user's schedule rule."""
+
+    def setUp(self):
+        """Create a user notified every 2 hours from 8:00 to 22:00."""
+        self.user_info = create_userinfo(50, 0, datetime.time(8, 0, 0), datetime.time(22, 0, 0))
+        self.user_info.time_interval = 2
+        self.user_info.total_hours = get_total_hours(self.user_info.first_notification_time,
+                                                     self.user_info.last_notification_time)
+        self.user_info.set_water_amount_per_day()
+        self.user_info.set_water_amount_per_hour()
+
+    def local_time(self, day, hour):
+        """Return an aware datetime on day at hour in the current time zone."""
+        return timezone.make_aware(datetime.datetime.combine(day, datetime.time(hour, 0, 0)))
+
+    def test_notification_times_of_today(self):
+        """Notification times run from the first time every interval, last one included."""
+        today = datetime.date(2022, 11, 5)
+        times = self.user_info.notification_times(self.local_time(today, 9))
+        self.assertEqual(8, self.user_info.notification_count)
+        self.assertEqual([self.local_time(today, hour) for hour in range(8, 23, 2)], times)
+
+    def test_notification_times_after_last_one(self):
+        """Once the last notification of today has passed, tomorrow's times are used."""
+        today = datetime.date(2022, 11, 5)
+        times = self.user_info.notification_times(self.local_time(today, 23))
+        self.assertEqual(self.local_time(today + datetime.timedelta(days=1), 8), times[0])
+
+
 class ScheduleViewTests(TestCase):
     """Test cases for schedule view."""
 
@@ -334,6 +453,19 @@ class ScheduleViewTests(TestCase):
         page = self.client.get(reverse('aquaholic:schedule', args=(self.user.id,)))
         self.assertEqual(page.status_code, 200)
 
+    def test_schedule_shows_delivery_state(self):
+        """A due reminder the dispatcher has not handled yet is shown as pending, in time order."""
+        user_info = UserInfo.objects.get(user_id=self.user.id)
+        now = timezone.now()
+        later = Schedule.objects.create(user_info=user_info, notification_time=now + timezone.timedelta(hours=1),
+                                        notification_status=False)
+        due = Schedule.objects.create(user_info=user_info, notification_time=now - timezone.timedelta(minutes=1),
+                                      notification_status=False)
+        page = self.client.get(reverse('aquaholic:schedule', args=(self.user.id,)))
+        schedule = [row for row in page.context['schedule'] if row.id in (due.id, later.id)]
+        self.assertEqual([due.id, later.id], [row.id for row in schedule])
+        self.assertFalse(schedule[0].notification_status)
+
     def test_turn_off_notification(self):
         """Set user_info.notification_turned_on == False when clicks turn off."""
         page = self.client.post(reverse('aquaholic:schedule', args=(self.user.id,)), data={'status': "turn_off"})
@@ -357,6 +489,26 @@ class ScheduleViewTests(TestCase):
         user_info1 = UserInfo.objects.get(user_id=self.user.id)
         self.assertTrue(user_info1.notification_turned_on)
 
+    def test_toggle_updates_schedules_in_bulk(self):
+        """Turning off marks every schedule done, turning on only the past ones, each with one UPDATE."""
+        user_info = UserInfo.objects.get(user_id=self.user.id)
+        now = timezone.now()
+        past = Schedule.objects.create(user_info=user_info, notification_time=now - timezone.timedelta(hours=1),
+                                       notification_status=True)
+        future = Schedule.objects.create(user_info=user_info, notification_time=now + timezone.timedelta(hours=1),
+                                         notification_status=False)
+        url = reverse('aquaholic:schedule', args=(self.user.id,))
+        with CaptureQueriesContext(connection) as queries:
+            self.client.post(url, data={'status': "turn_off"})
+        # one UPDATE for the toggle, one SELECT to render the schedule
+        schedule_queries = [query['sql'].split()[0] for query in queries.captured_queries
+                            if 'aquaholic_schedule' in query['sql']]
+        self.assertEqual(['UPDATE', 'SELECT'], schedule_queries)
+        self.assertTrue(Schedule.objects.get(id=future.id).notification_status)
+        self.client.post(url, data={'status': "turn_on"})
+        self.assertTrue(Schedule.objects.get(id=past.id).notification_status)
+        self.assertFalse(Schedule.objects.get(id=future.id).notification_status)
+
 
 class HistoryViewTests(TestCase):
     """Test cases for history page."""
@@ -439,6 +591,36 @@ class InputViewTests(TestCase):
         intake1 = Intake.objects.get(user_info_id=user_info.id, date=db_time)
         self.assertEqual(700, intake1.total_amount)
 
+    def test_add_to_existing_intake(self):
+        """Adding to an existing intake is a single UPDATE, and a second row of the same day is refused."""
+        user_info = UserInfo.objects.get(user_id=self.user1.id)
+        day = timezone.make_aware(datetime.datetime(2022, 11, 5, 10))
+        Intake.add(user_info.id, day, 200)
+        with CaptureQueriesContext(connection) as queries:
+            Intake.add(user_info.id, day, 300)
+        self.assertEqual(1, len(queries.captured_queries))
+        self.assertEqual(500, Intake.objects.get(user_info_id=user_info.id, date=day).total_amount)
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Intake.objects.create(user_info_id=user_info.id, date=day, total_amount=100)
+
+    def test_add_after_concurrent_insert(self):
+        """An intake created by another writer in the meantime gets the amount added."""
+        user_info = UserInfo.objects.get(user_id=self.user1.id)
+        day = timezone.make_aware(datetime.datetime(2022, 11, 5, 10))
+        atomic = transaction.atomic
+
+        @contextlib.contextmanager
+        def atomic_after_other_writer():
+            # the other writer inserts between our UPDATE and our INSERT
+            Intake.objects.create(user_info_id=user_info.id, date=day, total_amount=200)
+            with atomic():
+                yield
+
+        with patch.object(transaction, 'atomic', atomic_after_other_writer):
+            Intake.add(user_info.id, day, 300)
+        self.assertEqual([500], list(Intake.objects.filter(user_info_id=user_info.id, date=day
+                                                           ).values_list('total_amount', flat=True)))
+
     def test_input_invalid(self):
         """User amount of water input must be greater than 0."""
         # user input the amount of water and save
@@ -498,7 +680,23 @@ class AlertViewTests(TestCase):
 
 
 class NotificationTests(TestCase):
-    """Tests for methods in notification.py."""
+    """Tests for methods in notification.py, against the local LINE Notify emulator."""
+
+    @classmethod
+    def setUpClass(cls):
+        """Start the emulator and point the LINE urls at it."""
+        super().setUpClass()
+        cls.emulator = LineNotifyEmulator(tokens=["good-token"], revoked_tokens=["revoked-token"], codes=["good-code"],
+                                          rate_limit=2).start()
+        cls.line_urls = override_settings(LINE_NOTIFY_API_URL=cls.emulator.url, LINE_NOTIFY_BOT_URL=cls.emulator.url)
+        cls.line_urls.enable()
+
+    @classmethod
+    def tearDownClass(cls):
+        """Stop the emulator."""
+        cls.line_urls.disable()
+        cls.emulator.stop()
+        super().tearDownClass()
 
     def test_token_is_invalid(self):
         """Cannot send notification with invalid token.
@@ -520,14 +718,113 @@ class NotificationTests(TestCase):
         """Return None when input invalid code."""
         self.assertEqual(get_access_token("asjadk"), None)
 
+    def test_valid_token(self):
+        """A valid token is accepted and the code exchange returns a working token."""
+        self.assertEqual(200, check_token_status("good-token"))
+        token = get_access_token("good-code")
+        self.assertEqual(200, send_notification("Welcome to aquaholic", token))
+        self.assertEqual(401, send_notification("Hi", "revoked-token"))
+
+    def test_rate_limit_headers(self):
+        """LINE's rate limit headers are read, calls over the limit get 429."""
+        self.emulator.tokens.add("busy-token")
+        first = notify("Hi", "busy-token")
+        self.assertEqual(200, first.status)
+        self.assertEqual((2, 1), (first.rate_limit.limit, first.rate_limit.remaining))
+        self.assertEqual(0, notify("Hi", "busy-token").rate_limit.remaining)
+        self.assertEqual(429, notify("Hi", "busy-token").status)
+
+
+class LineClientTests(TestCase):
+    """Tests for the pooled LINE client and its circuit breaker."""
+
+    def setUp(self):
+        """Create a client whose breaker opens after two failures."""
+        self.line_client = LineClient(pool_size=2, connect_timeout=1, read_timeout=2, retries=0, backoff_factor=0,
+                                      failure_threshold=2, reset_timeout=60)
+
+    def test_request_uses_timeouts(self):
+        """Every call is made with the connect and read timeout."""
+        with patch.object(self.line_client.session, 'request', return_value=Mock(status_code=200)) as request:
+            self.line_client.request('GET', 'https://example.com')
+        request.assert_called_once_with('GET', 'https://example.com', timeout=(1, 2))
+
+    def test_status_of_a_non_json_answer(self):
+        """An error page without a JSON body gives its HTTP status instead of raising."""
+        response = Mock(status_code=502, headers={}, json=Mock(side_effect=ValueError("not JSON")))
+        with patch('aquaholic.notification.get_client', return_value=Mock(request=Mock(return_value=response))):
+            self.assertEqual(502, check_token_status("good-token"))
+            self.assertEqual(502, notify("Hi", "good-token").status)
+
+    def test_breaker_opens_after_failures(self):
+        """LINE is not called any more once the breaker is open."""
+        with patch.object(self.line_client.session, 'request', side_effect=requests.ConnectTimeout()) as request:
+            for _ in range(2):
+                with self.assertRaises(requests.ConnectTimeout):
+                    self.line_client.request('GET', 'https://example.com')
+            with self.assertRaises(NotificationUnavailable):
+                self.line_client.request('GET', 'https://example.com')
+        self.assertEqual(2, request.call_count)
+
+    def test_breaker_closes_after_successful_probe(self):
+        """After the reset timeout one probe goes through and closes the breaker."""
+        self.line_client.breaker.reset_timeout = 0
+        with patch.object(self.line_client.session, 'request', return_value=Mock(status_code=503)):
+            self.line_client.request('GET', 'https://example.com')
+            self.line_client.request('GET', 'https://example.com')
+        self.assertIsNotNone(self.line_client.breaker.opened_at)
+        with patch.object(self.line_client.session, 'request', return_value=Mock(status_code=200)):
+            self.line_client.request('GET', 'https://example.com')
+        self.assertIsNone(self.line_client.breaker.opened_at)
+
+    def test_open_breaker_defers_sends(self):
+        """A notification refused by the open breaker stays pending and is not counted as an attempt."""
+        user_info = create_userinfo(50, 0, datetime.time(8, 0, 0), datetime.time(22, 0, 0))
+        user_info.notify_token = "good-token"
+        user_info.notify_token_valid = True
+        user_info.save()
+        schedule = Schedule.objects.create(user_info=user_info, notification_status=False,
+                                           notification_time=timezone.now() - timezone.timedelta(minutes=1))
+        with patch('aquaholic.dispatcher.notify', side_effect=NotificationUnavailable("breaker open")):
+            update_notification()
+        message = OutboxMessage.objects.get(schedule=schedule)
+        self.assertEqual(OutboxMessage.PENDING, message.status)
+        self.assertEqual(0, message.attempts)
+        self.assertLessEqual(message.next_attempt_time, timezone.now())
+        self.assertEqual(1, DispatcherTick.objects.get().deferred)
+
 
 class UpdateNotificationViewTests(TestCase):
     """Tests for update notification view."""
 
     def test_get_update_notification_view(self):
-        """Can go to update notification view successfully."""
-        response = self.client.get(reverse('aquaholic:cron'))
-        self.assertEqual(response.status_code, 200)
+        """The cron view queues a tick and answers 202 with its id, the status view shows its progress."""
+        with patch('aquaholic.cron.threading.Thread') as thread:
+            response = self.client.get(reverse('aquaholic:cron'))
+            self.assertEqual(response.status_code, HTTPStatus.ACCEPTED)
+            tick_id = response.json()['tick']
+            self.assertEqual(tick_id, self.client.get(reverse('aquaholic:cron')).json()['tick'])
+        thread.assert_called_once_with(target=run_tick, args=(tick_id,), daemon=True)
+        status = self.client.get(response.json()['status_url'])
+        self.assertEqual('queued', status.json()['status'])
+        run_tick(tick_id)
+        self.assertEqual('done', self.client.get(response.json()['status_url']).json()['status'])
+        self.assertEqual(HTTPStatus.NOT_FOUND, self.client.get(reverse('aquaholic:cron_status', args=(0,))).status_code)
+
+    def test_start_tick_checks_under_the_start_lock(self):
+        """Concurrent pings are serialized: the start lock row is written before the in-flight check."""
+        with patch('aquaholic.cron.threading.Thread') as thread, \
+                CaptureQueriesContext(connection) as queries:
+            tick = start_tick()
+        thread.assert_called_once()
+        statements = [query['sql'] for query in queries.captured_queries]
+        lock = next(i for i, sql in enumerate(statements)
+                    if sql.startswith('UPDATE "aquaholic_dispatcherlock"') and "'start_tick'" in sql)
+        check = next(i for i, sql in enumerate(statements) if sql.startswith('SELECT "aquaholic_dispatchertick"'))
+        self.assertLess(lock, check)
+        with patch('aquaholic.cron.threading.Thread') as thread:
+            self.assertEqual(tick, start_tick())
+        thread.assert_not_called()
 
     def test_schedule_updates_correctly(self):
         """Schedule is updated correctly when visiting cron url.
@@ -555,14 +852,16 @@ class UpdateNotificationViewTests(TestCase):
         first_schedule_time = first_schedule.notification_time
         last_schedule_time = last_schedule.notification_time
         self.assertFalse(last_schedule.notification_status)
-        with patch.object(timezone, 'now', return_value=first_schedule_time + timezone.timedelta(minutes=10)):
+        with patch.object(timezone, 'now', return_value=first_schedule_time + timezone.timedelta(minutes=10)), \
+                run_ticks_inline():
             response = self.client.get(reverse('aquaholic:cron'))
-            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.status_code, HTTPStatus.ACCEPTED)
             new_first_schedule = Schedule.objects.filter(user_info_id=user_info.id).first()
             self.assertTrue(new_first_schedule.notification_status)
-        with patch.object(timezone, 'now', return_value=last_schedule_time + timezone.timedelta(minutes=10)):
+        with patch.object(timezone, 'now', return_value=last_schedule_time + timezone.timedelta(minutes=10)), \
+                run_ticks_inline():
             response = self.client.get(reverse('aquaholic:cron'))
-            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.status_code, HTTPStatus.ACCEPTED)
             new_last_schedule = Schedule.objects.filter(user_info_id=user_info.id,
                                                         is_last=True).first()
             new_last_schedule_time = new_last_schedule.notification_time
@@ -571,6 +870,531 @@ class UpdateNotificationViewTests(TestCase):
             self.assertFalse(new_last_schedule.notification_status)
 
 
+class DispatcherTests(TestCase):
+    """Tests for sending due notifications concurrently."""
+
+    def setUp(self):
+        """Create two users, each with one schedule that is already due."""
+        self.ok_user = create_userinfo(50, 0, datetime.time(8, 0, 0), datetime.time(22, 0, 0))
+        self.ok_user.notify_token = "good-token"
+        self.ok_user.notify_token_valid = True
+        self.ok_user.save()
+        self.down_user = create_userinfo(50, 0, datetime.time(8, 0, 0), datetime.time(22, 0, 0))
+        self.down_user.notify_token = "down-token"
+        self.down_user.notify_token_valid = True
+        self.down_user.save()
+        due_time = timezone.now() - timezone.timedelta(minutes=5)
+        self.ok_schedule = Schedule.objects.create(user_info=self.ok_user, notification_time=due_time,
+                                                   expected_amount=150, notification_status=False)
+        self.down_schedule = Schedule.objects.create(user_info=self.down_user, notification_time=due_time,
+                                                     expected_amount=150, notification_status=False)
+
+    @staticmethod
+    def fake_send(message, token):
+        """Answer 200 for the good token and fail to connect for the other one."""
+        if token == "down-token":
+            raise requests.ConnectionError("LINE is down")
+        return NotifyResult(200, None)
+
+    def test_send_all_collects_results(self):
+        """Every job gets a result, failures carry the error."""
+        with patch('aquaholic.dispatcher.notify', side_effect=self.fake_send):
+            results = send_all([(1, "Hi", "good-token"), (2, "Hi", "down-token")], max_workers=2)
+        self.assertEqual([1, 2], [result.job_id for result in results])
+        self.assertEqual(200, results[0].status)
+        self.assertIsNone(results[0].error)
+        self.assertIsInstance(results[1].error, requests.ConnectionError)
+
+    def test_failed_send_stays_in_outbox(self):
+        """A notification whose send failed is kept in the outbox for a later retry."""
+        with patch('aquaholic.dispatcher.notify', side_effect=self.fake_send) as send:
+            update_notification()
+        send.assert_any_call("Don't forget to drink 150 ml of water", "good-token")
+        self.ok_schedule.refresh_from_db()
+        self.down_schedule.refresh_from_db()
+        self.assertTrue(self.ok_schedule.notification_status)
+        self.assertTrue(self.down_schedule.notification_status)
+        self.assertEqual(OutboxMessage.SENT, OutboxMessage.objects.get(schedule=self.ok_schedule).status)
+        failed = OutboxMessage.objects.get(schedule=self.down_schedule)
+        self.assertEqual(OutboxMessage.PENDING, failed.status)
+        self.assertEqual(1, failed.attempts)
+        self.assertIn("LINE is down", failed.last_error)
+
+    def test_tick_records_metrics(self):
+        """Each tick stores its counts and lag, and the metrics page shows the latest one.
+
+        A reminder coalesced into another one of the same user counts as skipped.
+        """
+        Schedule.objects.create(user_info=self.ok_user, notification_time=timezone.now() - timezone.timedelta(hours=1),
+                                expected_amount=150, notification_status=False)
+        with patch('aquaholic.dispatcher.notify', side_effect=self.fake_send):
+            update_notification()
+        tick = DispatcherTick.objects.get()
+        self.assertEqual((3, 1, 1, 1, 0), (tick.due, tick.sent, tick.failed, tick.skipped, tick.backlog))
+        # measured from the earliest of the coalesced reminders
+        self.assertGreaterEqual(tick.max_lag, 3600)
+        self.assertIsNotNone(tick.latency_p99)
+        response = self.client.get(reverse('aquaholic:cron_metrics'))
+        self.assertEqual(HTTPStatus.OK, response.status_code)
+        self.assertIn("aquaholic_tick_sent 1\n", response.content.decode())
+        self.assertIn("aquaholic_tick_skipped 1\n", response.content.decode())
+        self.assertIn('aquaholic_send_latency_seconds{quantile="0.95"}', response.content.decode())
+
+    def test_only_2xx_counts_as_sent(self):
+        """Answers other than 2xx are counted as failed, deferred sends as deferred."""
+        stats = TickStats()
+        now = timezone.now()
+        results = [SendResult(1, 200, None), SendResult(2, 500, requests.HTTPError("LINE answered 500")),
+                   SendResult(3, 401, None), SendResult(4, None, requests.HTTPError("no LINE token")),
+                   SendResult(5, 429, SendDeferred("LINE answered 429"))]
+        stats.record_sends(results, {job_id: now - timezone.timedelta(seconds=30) for job_id in range(1, 6)}, now)
+        self.assertEqual((1, 3, 1), (stats.sent, stats.failed, stats.deferred))
+        self.assertEqual(30, stats.max_lag)
+
+    def test_percentile(self):
+        """Percentiles use the nearest rank."""
+        values = list(range(1, 101))
+        self.assertEqual(50, percentile(values, 50))
+        self.assertEqual(99, percentile(values, 99))
+        self.assertIsNone(percentile([], 50))
+
+    def test_tick_drains_while_another_tick_holds_the_lock(self):
+        """A tick that finds the tick lock held enqueues nothing but still drains the outbox."""
+        now = timezone.now()
+        OutboxMessage.objects.create(schedule=self.ok_schedule, user_info=self.ok_user, expected_amount=150,
+                                     scheduled_time=self.ok_schedule.notification_time, next_attempt_time=now)
+        self.assertTrue(acquire_tick_lock("enqueueing-tick", now, 60))
+        with patch('aquaholic.dispatcher.notify', side_effect=self.fake_send) as send:
+            self.assertEqual(0, update_notification())
+            send.assert_called_once_with("Don't forget to drink 150 ml of water", "good-token")
+            self.down_schedule.refresh_from_db()
+            self.assertFalse(self.down_schedule.notification_status)
+            self.assertEqual("enqueueing-tick", DispatcherLock.objects.get().holder)
+            DispatcherLock.objects.update(lease_until=now - timezone.timedelta(seconds=1))
+            update_notification()
+        self.down_schedule.refresh_from_db()
+        self.assertTrue(self.down_schedule.notification_status)
+        self.assertEqual('', DispatcherLock.objects.get().holder)
+
+    @override_settings(NOTIFICATION_TICK_BUDGET=0)
+    def test_tick_stops_at_its_budget(self):
+        """Nothing is sent once the budget is used up, the backlog is left for the next tick."""
+        with patch('aquaholic.dispatcher.notify', side_effect=self.fake_send) as send:
+            self.assertEqual(2, update_notification())
+        send.assert_not_called()
+        self.assertEqual(2, OutboxMessage.objects.filter(status=OutboxMessage.PENDING).count())
+
+
+class OutboxTests(TestCase):
+    """Tests for the durable notification outbox."""
+
+    def setUp(self):
+        """Create a user with one due schedule."""
+        self.user_info = create_userinfo(50, 0, datetime.time(8, 0, 0), datetime.time(22, 0, 0))
+        self.user_info.notify_token = "down-token"
+        self.user_info.notify_token_valid = True
+        self.user_info.save()
+        self.now = timezone.now()
+        self.schedule = Schedule.objects.create(user_info=self.user_info, notification_status=False,
+                                                notification_time=self.now - timezone.timedelta(minutes=1),
+                                                expected_amount=200)
+
+    def test_enqueue_is_idempotent(self):
+        """A due schedule is enqueued once, even if it is found due again."""
+        self.assertEqual((1, 1), enqueue_due_schedules(self.now))
+        Schedule.objects.filter(id=self.schedule.id).update(notification_status=False)
+        enqueue_due_schedules(self.now)
+        self.assertEqual(1, OutboxMessage.objects.count())
+        message = OutboxMessage.objects.get()
+        self.assertEqual(200, message.expected_amount)
+        self.assertEqual(self.schedule.notification_time, message.scheduled_time)
+
+    @override_settings(NOTIFICATION_MAX_ATTEMPTS=3, NOTIFICATION_RETRY_DELAY=60)
+    def test_retry_with_backoff_then_dead_letter(self):
+        """Failed sends wait twice as long each time and are dead-lettered at the last attempt."""
+        enqueue_due_schedules(self.now)
+        now = self.now
+        with patch('aquaholic.dispatcher.notify', side_effect=requests.ConnectionError("LINE is down")):
+            self.assertEqual(1, drain_outbox(now))
+            message = OutboxMessage.objects.get()
+            self.assertEqual(now + timezone.timedelta(seconds=60), message.next_attempt_time)
+            self.assertEqual(0, drain_outbox(now))  # not due yet
+            now = message.next_attempt_time
+            drain_outbox(now)
+            message.refresh_from_db()
+            self.assertEqual(now + timezone.timedelta(seconds=120), message.next_attempt_time)
+            drain_outbox(message.next_attempt_time)
+        message.refresh_from_db()
+        self.assertEqual(OutboxMessage.DEAD, message.status)
+        self.assertEqual(3, message.attempts)
+
+    @override_settings(NOTIFICATION_RETRY_DELAY=60)
+    def test_server_error_is_retried(self):
+        """A notification LINE answered with 5xx is a failed attempt, not a delivery."""
+        enqueue_due_schedules(self.now)
+        with patch('aquaholic.dispatcher.notify', return_value=NotifyResult(500, None)):
+            drain_outbox(self.now)
+        message = OutboxMessage.objects.get()
+        self.assertEqual(OutboxMessage.PENDING, message.status)
+        self.assertEqual(1, message.attempts)
+        self.assertEqual("LINE answered 500", message.last_error)
+        self.assertEqual(self.now + timezone.timedelta(seconds=60), message.next_attempt_time)
+        with patch('aquaholic.dispatcher.notify', return_value=NotifyResult(200, None)):
+            drain_outbox(message.next_attempt_time)
+        self.assertEqual(OutboxMessage.SENT, OutboxMessage.objects.get().status)
+
+    def test_purge_sent_messages(self):
+        """Sent messages are deleted after the retention period, others are kept."""
+        enqueue_due_schedules(self.now)
+        OutboxMessage.objects.update(status=OutboxMessage.SENT, sent_time=self.now - timezone.timedelta(days=30))
+        purge_outbox(self.now)
+        self.assertFalse(OutboxMessage.objects.exists())
+
+    @override_settings(NOTIFICATION_AUTH_FAILURE_LIMIT=2)
+    def test_revoked_token_is_pruned(self):
+        """A token refused with 401 twice in a row is invalidated and its schedules are no longer enqueued."""
+        with patch('aquaholic.dispatcher.notify', return_value=NotifyResult(401, None)):
+            enqueue_due_schedules(self.now)
+            drain_outbox(self.now)
+            self.user_info.refresh_from_db()
+            self.assertEqual(1, self.user_info.notify_auth_failures)
+            self.assertTrue(self.user_info.notify_token_valid)
+            Schedule.objects.update(notification_status=False, notification_time=self.now)
+            enqueue_due_schedules(self.now)
+            drain_outbox(self.now)
+        self.user_info.refresh_from_db()
+        self.assertFalse(self.user_info.notify_token_valid)
+        self.assertEqual(1, DispatcherCounter.get_value(DispatcherCounter.TOKENS_PRUNED))
+        Schedule.objects.update(notification_status=False, notification_time=self.now + timezone.timedelta(minutes=1))
+        self.assertEqual((0, 0), enqueue_due_schedules(self.now + timezone.timedelta(minutes=1)))
+        self.assertEqual(2, OutboxMessage.objects.count())
+        self.assertFalse(Schedule.objects.get().notification_status)
+
+    def test_overdue_reminders_are_coalesced(self):
+        """After an outage a user gets one message asking for every missed amount."""
+        for hours in (1, 2):
+            Schedule.objects.create(user_info=self.user_info, notification_status=False, expected_amount=200,
+                                    notification_time=self.now - timezone.timedelta(hours=hours))
+        self.assertEqual((3, 1), enqueue_due_schedules(self.now))
+        message = OutboxMessage.objects.get()
+        self.assertEqual(600, message.expected_amount)
+        self.assertEqual(self.schedule.id, message.schedule_id)
+        self.assertFalse(Schedule.objects.filter(notification_status=False).exists())
+
+    @override_settings(NOTIFICATION_BATCH_SIZE=2)
+    def test_enqueue_reads_due_schedules_in_chunks(self):
+        """A user whose reminders span several chunks still gets one message with every amount."""
+        other = create_userinfo(50, 0, datetime.time(8, 0, 0), datetime.time(22, 0, 0))
+        UserInfo.objects.filter(id=other.id).update(notify_token="other-token", notify_token_valid=True)
+        for user_info in (self.user_info, self.user_info, other):
+            Schedule.objects.create(user_info=user_info, notification_status=False, expected_amount=100,
+                                    notification_time=self.now - timezone.timedelta(minutes=30))
+        self.assertEqual([2, 2], [len(rows) for rows in due_chunks(self.now)])
+        self.assertEqual((4, 2), enqueue_due_schedules(self.now))
+        amounts = dict(OutboxMessage.objects.values_list('user_info_id', 'expected_amount'))
+        self.assertEqual({self.user_info.id: 400, other.id: 100}, amounts)
+        self.assertFalse(Schedule.objects.filter(notification_status=False).exists())
+
+    def test_one_status_update_per_slot(self):
+        """Users sharing a reminder time are marked handled by a single UPDATE, users without a token are left out."""
+        for token_valid in (True, True, True, True, True, False):
+            user_info = create_userinfo(50, 0, datetime.time(8, 0, 0), datetime.time(22, 0, 0))
+            UserInfo.objects.filter(id=user_info.id).update(notify_token="token", notify_token_valid=token_valid)
+            Schedule.objects.create(user_info=user_info, notification_status=False,
+                                    notification_time=self.schedule.notification_time)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual((6, 6), enqueue_due_schedules(self.now))
+        updates = [query['sql'] for query in queries.captured_queries
+                   if query['sql'].startswith('UPDATE "aquaholic_schedule"')]
+        self.assertEqual(2, len(updates))  # the slot, and schedules left without a user
+        self.assertEqual(1, Schedule.objects.filter(notification_status=False).count())
+        self.assertFalse(Schedule.objects.filter(notification_status=False, user_info__notify_token_valid=True).exists())
+
+    @override_settings(NOTIFICATION_STALE_AFTER=3600)
+    def test_stale_reminders_are_dropped(self):
+        """Reminders older than the staleness window are skipped without being sent."""
+        Schedule.objects.filter(id=self.schedule.id).update(notification_time=self.now - timezone.timedelta(hours=2))
+        self.assertEqual((1, 0), enqueue_due_schedules(self.now))
+        self.assertFalse(OutboxMessage.objects.exists())
+        self.assertTrue(Schedule.objects.get().notification_status)
+
+    def test_reminder_follows_todays_intake(self):
+        """A user close to the goal is asked for the rest, a user who met it is not reminded."""
+        UserInfo.objects.filter(id=self.user_info.id).update(water_amount_per_day=1000)
+        intake = Intake.objects.create(user_info=self.user_info, date=self.now, total_amount=900)
+        enqueue_due_schedules(self.now)
+        with patch('aquaholic.dispatcher.notify', return_value=NotifyResult(200, None)) as notify:
+            drain_outbox(self.now)
+            notify.assert_called_once_with("Don't forget to drink 100 ml of water", "down-token")
+            intake.total_amount = 1000
+            intake.save()
+            OutboxMessage.objects.update(status=OutboxMessage.PENDING)
+            drain_outbox(self.now)
+        notify.assert_called_once()
+        self.assertEqual(OutboxMessage.SKIPPED, OutboxMessage.objects.get().status)
+
+    def test_workers_claim_disjoint_batches(self):
+        """Two workers never lease the same message."""
+        for _ in range(4):
+            user_info = create_userinfo(50, 0, datetime.time(8, 0, 0), datetime.time(22, 0, 0))
+            UserInfo.objects.filter(id=user_info.id).update(notify_token="token", notify_token_valid=True)
+            Schedule.objects.create(user_info=user_info, notification_status=False, notification_time=self.now)
+        enqueue_due_schedules(self.now)
+        first = claim_batch('worker-1', self.now, batch_size=3)
+        second = claim_batch('worker-2', self.now, batch_size=3)
+        self.assertEqual(3, len(first))
+        self.assertEqual(2, len(second))
+        self.assertFalse(set(first) & set(second))
+        self.assertEqual([], claim_batch('worker-3', self.now))
+
+    def test_lease_runs_from_the_claim_time(self):
+        """A batch claimed late in a long drain is leased from the time of the claim, not of the tick."""
+        enqueue_due_schedules(self.now)
+        tick_start = self.now - timezone.timedelta(hours=1)
+        OutboxMessage.objects.update(next_attempt_time=tick_start)
+        claim_batch('slow-worker', tick_start)
+        self.assertGreater(OutboxMessage.objects.get().lease_until, timezone.now())
+        self.assertEqual([], claim_batch('other-worker', timezone.now()))
+
+    def test_leased_message_is_skipped_until_the_lease_expires(self):
+        """A message leased by a live worker is not sent, once its lease expires it is sent again."""
+        enqueue_due_schedules(self.now)
+        claim_batch('crashed-worker', self.now)
+        with patch('aquaholic.dispatcher.notify', return_value=NotifyResult(200, None)) as notify:
+            self.assertEqual(0, drain_outbox(self.now))
+            later = OutboxMessage.objects.get().lease_until + timezone.timedelta(seconds=1)
+            self.assertEqual(1, drain_outbox(later, worker='worker-2'))
+        notify.assert_called_once()
+        message = OutboxMessage.objects.get()
+        self.assertEqual(OutboxMessage.SENT, message.status)
+        self.assertEqual('', message.claimed_by)
+        self.assertIsNone(message.lease_until)
+
+
+class RolloverTests(TestCase):
+    """Tests for moving finished schedules to the next day."""
+
+    def create_finished_schedule(self, notification_turned_on):
+        """Create a user with two sent schedules, the last of which has fired."""
+        user_info = create_userinfo(50, 0, datetime.time(8, 0, 0), datetime.time(22, 0, 0))
+        user_info.notification_turned_on = notification_turned_on
+        user_info.notify_token_valid = True
+        user_info.save()
+        fired = timezone.now() - timezone.timedelta(hours=1)
+        for hours_before, is_last in ((1, False), (0, True)):
+            Schedule.objects.create(user_info=user_info, notification_time=fired - timezone.timedelta(hours=hours_before),
+                                    notification_status=True, is_last=is_last)
+        return user_info
+
+    def test_rollover_follows_notification_setting(self):
+        """All schedules move 24 hours ahead, only turned on users are reset to not sent."""
+        turned_on = self.create_finished_schedule(True)
+        turned_off = self.create_finished_schedule(False)
+        before = {schedule.id: schedule.notification_time for schedule in Schedule.objects.all()}
+        rollover_schedules(timezone.now())
+        for schedule in Schedule.objects.all():
+            self.assertEqual(before[schedule.id] + timezone.timedelta(hours=24), schedule.notification_time)
+        self.assertFalse(Schedule.objects.filter(user_info=turned_on, notification_status=True).exists())
+        self.assertFalse(Schedule.objects.filter(user_info=turned_off, notification_status=False).exists())
+
+    def test_pending_last_schedule_is_not_rolled_over(self):
+        """Nothing moves while the last schedule has not been sent yet."""
+        user_info = self.create_finished_schedule(True)
+        Schedule.objects.filter(user_info=user_info, is_last=True).update(notification_status=False)
+        before = list(Schedule.objects.values_list('notification_time', flat=True).order_by('id'))
+        rollover_schedules(timezone.now())
+        self.assertEqual(before, list(Schedule.objects.values_list('notification_time', flat=True).order_by('id')))
+
+    def test_schedules_without_token_roll_over(self):
+        """Schedules of a user without a valid token are never sent, they move on once their last time has passed."""
+        user_info = self.create_finished_schedule(True)
+        UserInfo.objects.filter(id=user_info.id).update(notify_token_valid=False)
+        Schedule.objects.update(notification_status=False)
+        before = list(Schedule.objects.values_list('notification_time', flat=True).order_by('id'))
+        rollover_schedules(timezone.now())
+        after = list(Schedule.objects.values_list('notification_time', flat=True).order_by('id'))
+        self.assertEqual([time + timezone.timedelta(hours=24) for time in before], after)
+
+
+class SendThrottleTests(TestCase):
+    """Tests for throttling sends with LINE's rate limit headers."""
+
+    def test_parse_rate_limit(self):
+        """Rate limit headers are read as numbers, missing headers give None."""
+        rate_limit = parse_rate_limit({'X-RateLimit-Limit': '1000', 'X-RateLimit-Remaining': '999',
+                                       'X-RateLimit-Reset': '1700000000'})
+        self.assertEqual(RateLimit(1000, 999, 1700000000), rate_limit)
+        self.assertIsNone(parse_rate_limit({}))
+
+    def test_token_out_of_budget_is_deferred(self):
+        """A token with no remaining calls is not sent to until its reset time."""
+        throttle = SendThrottle(max_rate=100, burst=100, max_wait=0)
+        throttle.update("token", 200, RateLimit(1000, 1, time.time() + 3600))
+        self.assertTrue(throttle.acquire("token"))
+        self.assertFalse(throttle.acquire("token"))
+        self.assertTrue(throttle.acquire("other-token"))
+        throttle.update("token", 200, RateLimit(1000, 0, time.time() - 1))
+        self.assertTrue(throttle.acquire("token"))
+
+    def test_global_bucket_and_429(self):
+        """The global bucket limits the burst and a 429 halves its rate."""
+        throttle = SendThrottle(max_rate=10, burst=2, max_wait=0)
+        self.assertTrue(throttle.acquire("a"))
+        self.assertTrue(throttle.acquire("b"))
+        self.assertFalse(throttle.acquire("c"))
+        throttle.update("a", 429, None)
+        self.assertEqual(5, throttle.bucket.rate)
+        self.assertFalse(throttle.acquire("a"))
+
+    def test_rate_limited_send_stays_pending(self):
+        """A notification answered with 429 is deferred, not counted as an attempt."""
+        user_info = create_userinfo(50, 0, datetime.time(8, 0, 0), datetime.time(22, 0, 0))
+        user_info.notify_token = "busy-token"
+        user_info.notify_token_valid = True
+        user_info.save()
+        schedule = Schedule.objects.create(user_info=user_info, notification_status=False,
+                                           notification_time=timezone.now() - timezone.timedelta(minutes=1))
+        throttle = SendThrottle(max_rate=100, burst=100, max_wait=0)
+        with patch('aquaholic.dispatcher.notify', return_value=NotifyResult(429, None)):
+            results = send_all([(schedule.id, "Hi", "busy-token")], throttle=throttle)
+        self.assertIsInstance(results[0].error, SendDeferred)
+        with patch('aquaholic.dispatcher.get_throttle', return_value=throttle), \
+                patch('aquaholic.dispatcher.notify') as send:
+            update_notification()
+        send.assert_not_called()
+        message = OutboxMessage.objects.get(schedule=schedule)
+        self.assertEqual(OutboxMessage.PENDING, message.status)
+        self.assertEqual(0, message.attempts)
+
+
+class DispatcherDaemonTests(TestCase):
+    """Tests for the long-running dispatcher and its queue of due times."""
+
+    def setUp(self):
+        """Create a user with two schedules due now and one due in ten minutes."""
+        self.user_info = create_userinfo(50, 0, datetime.time(8, 0, 0), datetime.time(22, 0, 0))
+        self.user_info.notify_token = "good-token"
+        self.user_info.notify_token_valid = True
+        self.user_info.save()
+        self.now = timezone.now().replace(microsecond=0)
+        for minutes in (0, 0, 10):
+            Schedule.objects.create(user_info=self.user_info, notification_status=False,
+                                    notification_time=self.now + timezone.timedelta(minutes=minutes))
+
+    def test_queue_keeps_distinct_due_times(self):
+        """Schedules due at the same second share one entry."""
+        queue = DueQueue(horizon=3600)
+        queue.load(self.now)
+        self.assertEqual(2, len(queue))
+        self.assertEqual(int(self.now.timestamp()), queue.next_due())
+        self.assertEqual([int(self.now.timestamp())], queue.pop_due(self.now))
+        self.assertEqual(int(self.now.timestamp()) + 600, queue.next_due())
+
+    def test_queue_horizon_and_left_over(self):
+        """Only the horizon is loaded and entries left over by a tick are retried later."""
+        queue = DueQueue(horizon=60)
+        queue.load(self.now, last_tick=self.now, retry_interval=30)
+        self.assertEqual([int(self.now.timestamp()) + 30], queue.heap)
+
+    def test_run_dispatcher_sends_due_notifications(self):
+        """The daemon runs a tick as soon as something is due."""
+        with patch('aquaholic.management.commands.run_dispatcher.close_old_connections'), \
+                patch('aquaholic.dispatcher.notify', return_value=NotifyResult(200, None)):
+            out = StringIO()
+            call_command('run_dispatcher', max_ticks=1, stdout=out)
+        self.assertIn("Dispatcher stopped after 1 ticks.", out.getvalue())
+        self.assertEqual(1, OutboxMessage.objects.filter(status=OutboxMessage.SENT).count())
+        self.assertEqual(1, Schedule.objects.filter(notification_status=False).count())
+
+
+class SimulationTests(TestCase):
+    """Tests for replaying dispatcher ticks against a virtual clock."""
+
+    def test_two_days_send_every_reminder_once_and_on_time(self):
+        """Every reminder of every day is sent exactly once, at its minute, and the table does not grow."""
+        start = timezone.make_aware(datetime.datetime(2022, 11, 5))
+        simulation = Simulation(users=5, days=2, start=start, rng=random.Random(1))
+        simulation.seed()
+        per_day = sum(UserInfo.objects.values_list('notification_count', flat=True))
+        report = simulation.run()
+        self.assertEqual([per_day, per_day], report['sends_per_day'])
+        self.assertEqual(0, report['late_sends'])
+        self.assertEqual(0, report['duplicate_sends'])
+        self.assertEqual([per_day, per_day], report['schedule_rows_per_day'])
+
+
+class TokenStatusTests(TestCase):
+    """Tests for storing whether a user's LINE notify token is valid."""
+
+    def setUp(self):
+        """Login and register a user."""
+        self.user = User.objects.create(username='testuser')
+        self.user.set_password('12345')
+        self.user.save()
+        self.client.login(username='testuser', password='12345')
+        self.client.get(reverse('aquaholic:home'))
+        self.client.post(reverse("aquaholic:registration", args=(self.user.id,)),
+                         data={"weight": 50, "exercise_duration": 0})
+
+    def test_callback_stores_token_status(self):
+        """Connecting LINE notify stores the token as valid right away."""
+        with patch('aquaholic.views.get_access_token', return_value="new-token"), \
+                patch('aquaholic.views.send_notification', return_value=200):
+            self.client.get(reverse('aquaholic:callback'), data={'code': 'code'})
+        user_info = UserInfo.objects.get(user_id=self.user.id)
+        self.assertTrue(user_info.notify_token_valid)
+        self.assertIsNotNone(user_info.notify_token_checked_time)
+        response = self.client.get(reverse('aquaholic:line_connect', args=(self.user.id,)))
+        self.assertTrue(response.context['has_token'])
+
+    def test_callback_leaves_token_unchecked_when_line_is_down(self):
+        """A welcome message that fails with 503 leaves the new token for the sweep to check."""
+        with patch('aquaholic.views.get_access_token', return_value="new-token"), \
+                patch('aquaholic.views.send_notification', return_value=503):
+            self.client.get(reverse('aquaholic:callback'), data={'code': 'code'})
+        user_info = UserInfo.objects.get(user_id=self.user.id)
+        self.assertEqual("new-token", user_info.notify_token)
+        self.assertFalse(user_info.notify_token_valid)
+        self.assertIsNone(user_info.notify_token_checked_time)
+
+    def test_callback_without_token(self):
+        """When LINE issues no token the user stays unconnected and no welcome message is sent."""
+        with patch('aquaholic.views.get_access_token', return_value=None), \
+                patch('aquaholic.views.send_notification') as send:
+            response = self.client.get(reverse('aquaholic:callback'), data={'code': 'code'})
+        self.assertEqual(302, response.status_code)
+        send.assert_not_called()
+        user_info = UserInfo.objects.get(user_id=self.user.id)
+        self.assertIsNone(user_info.notify_token)
+        self.assertFalse(user_info.notify_token_valid)
+
+    def test_sweep_updates_stored_status(self):
+        """The token sweep stores LINE's answer and keeps the state of unchecked tokens."""
+        revoked = create_userinfo(50, 0, datetime.time(8, 0, 0), datetime.time(22, 0, 0))
+        unreachable = create_userinfo(50, 0, datetime.time(8, 0, 0), datetime.time(22, 0, 0))
+        UserInfo.objects.filter(id=revoked.id).update(notify_token="revoked", notify_token_valid=True)
+        UserInfo.objects.filter(id=unreachable.id).update(notify_token="unreachable", notify_token_valid=True)
+        failing = create_userinfo(50, 0, datetime.time(8, 0, 0), datetime.time(22, 0, 0))
+        UserInfo.objects.filter(id=failing.id).update(notify_token="failing", notify_token_valid=True)
+        UserInfo.objects.filter(user_id=self.user.id).update(notify_token="good")
+
+        def fake_status(token):
+            if token == "unreachable":
+                raise requests.ConnectTimeout()
+            return {"good": 200, "failing": 500}.get(token, 401)
+
+        with patch('aquaholic.cron.check_token_status', side_effect=fake_status):
+            out = StringIO()
+            call_command('check_notify_tokens', stdout=out)
+        self.assertIn("Checked 2 LINE notify tokens.", out.getvalue())
+        self.assertTrue(UserInfo.objects.get(user_id=self.user.id).notify_token_valid)
+        self.assertFalse(UserInfo.objects.get(id=revoked.id).notify_token_valid)
+        self.assertTrue(UserInfo.objects.get(id=unreachable.id).notify_token_valid)
+        self.assertIsNone(UserInfo.objects.get(id=unreachable.id).notify_token_checked_time)
+        self.assertTrue(UserInfo.objects.get(id=failing.id).notify_token_valid)
+        self.assertIsNone(UserInfo.objects.get(id=failing.id).notify_token_checked_time)
+
+
 class LineNotifyConnectViewTests(TestCase):
     """Tests for line notify connect view."""
 
@@ -0,0 +1,100 @@
+"""A module that keeps LINE notification sends inside LINE's rate limits."""
+import threading
+import time
+
+# how long a token is left alone after a 429 that came without rate limit headers
+DEFAULT_BLOCK_SECONDS = 60
+
+
+class TokenBucket:
+    """A token bucket refilled at rate tokens per second, holding at most capacity tokens."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+
+    def refill(self):
+        """Add the tokens earned since the last refill."""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def wait_time(self):
+        """Return the seconds until one token is available."""
+        self.refill()
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        """Take one token, return False if the bucket is empty."""
+        self.refill()
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class SendThrottle:
+    """An adaptive throttle for LINE notify, global and per token.
+
+    The global bucket limits the sends per second of this process. Its rate
+    is halved whenever LINE answers 429 and grows back by one send per
+    second after each accepted send, up to max_rate. Every token also has
+    the budget LINE reports in its X-RateLimit-Remaining/X-RateLimit-Reset
+    headers; a token whose budget is used up is not sent to until the reset
+    time. A send that is not allowed is deferred, never dropped.
+    """
+
+    def __init__(self, max_rate, burst, max_wait):
+        self.max_rate = max_rate
+        self.min_rate = max(max_rate / 16, 0.1)
+        self.max_wait = max_wait
+        self.bucket = TokenBucket(max_rate, burst)
+        self.token_budgets = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, token):
+        """Return True when a notification may be sent with token now.
+
+        Waits up to max_wait seconds for the global bucket, returns False
+        straight away if the token itself is out of budget.
+        """
+        deadline = time.monotonic() + self.max_wait
+        while True:
+            with self._lock:
+                budget = self.token_budgets.get(token)
+                if budget is not None and budget[1] <= time.time():
+                    del self.token_budgets[token]
+                    budget = None
+                if budget is not None and budget[0] <= 0:
+                    return False
+                wait = self.bucket.wait_time()
+                if wait == 0:
+                    self.bucket.take()
+                    if budget is not None:
+                        self.token_budgets[token] = (budget[0] - 1, budget[1])
+                    return True
+            if time.monotonic() + wait > deadline:
+                return False
+            time.sleep(wait)
+
+    def update(self, token, status, rate_limit):
+        """Adapt the throttle to LINE's answer for token."""
+        with self._lock:
+            if rate_limit is not None and None not in (rate_limit.remaining, rate_limit.reset):
+                remaining = 0 if status == 429 else rate_limit.remaining
+                self.token_budgets[token] = (remaining, rate_limit.reset)
+            elif status == 429:
+                self.token_budgets[token] = (0, time.time() + DEFAULT_BLOCK_SECONDS)
+            self.bucket.refill()
+            if status == 429:
+                self.bucket.rate = max(self.min_rate, self.bucket.rate / 2)
+            else:
+                self.bucket.rate = min(self.max_rate, self.bucket.rate + 1)
+
+
+class SendDeferred(Exception):
+    """The send was postponed to a later tick to stay inside LINE's rate limits."""
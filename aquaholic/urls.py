@@ -23,6 +23,8 @@ urlpatterns = [
     path('aquaholic/about_us', views.AboutUsView.as_view(), name='about_us'),
     path('aquaholic/<int:pk>/profile', views.ProfileView.as_view(), name="profile"),
     path('aquaholic/cron', views.update_notification, name='cron'),
+    path('aquaholic/cron/metrics', views.dispatcher_metrics, name='cron_metrics'),
+    path('aquaholic/cron/<int:pk>', views.tick_status, name='cron_status'),
     path('aquaholic/alert', views.login_alert, name='alert'),
     path('aquaholic/line_notify', views.LineNotifyVerificationView.as_view(), name="line_notify"),
     path('aquaholic/<int:pk>/line_connect', views.LineNotifyConnect.as_view(), name="line_connect")
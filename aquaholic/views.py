@@ -1,15 +1,18 @@
 """Views for Aquaholic application."""
 import datetime
 import calendar
+from http import HTTPStatus
 from decouple import config
 from django.views import generic
-from django.shortcuts import reverse, render
-from django.http import HttpResponseRedirect, HttpResponse
+from django.shortcuts import get_object_or_404, reverse, render
+from django.http import HttpResponseRedirect, HttpResponse, JsonResponse
+from django.db import transaction
 from django.utils import timezone
 from django.utils.timezone import make_aware
 from django.contrib.auth.mixins import LoginRequiredMixin
-from .models import Schedule, Intake, UserInfo, KILOGRAM_TO_POUND, OUNCES_TO_MILLILITER
-from .notification import get_access_token, send_notification, check_token_status
+from . import cron, metrics
+from .models import DispatcherTick, Schedule, Intake, UserInfo, KILOGRAM_TO_POUND, OUNCES_TO_MILLILITER
+from .notification import get_access_token, send_notification
 
 
 def get_total_hours(first_notification_time, last_notification_time):
@@ -39,19 +42,17 @@ class HomePageView(generic.ListView):
         if not user.is_authenticated:
             return render(request, self.template_name)
         # for new user, create new user info
-        if not UserInfo.objects.filter(user_id=user.id).exists():
-            UserInfo.objects.create(user_id=user.id)
-        user_info = UserInfo.objects.get(user_id=user.id)
+        user_info = UserInfo.for_user(user)
         if user_info.water_amount_per_day == 0:
             return HttpResponseRedirect(reverse("aquaholic:registration", args=(user.id,)))
-        if not Intake.objects.filter(user_info_id=user_info.id, date=date).exists():
+        intake = Intake.objects.filter(user_info_id=user_info.id, date=date
+                                       ).values_list('total_amount', flat=True).first()
+        if intake is None:
             return render(request, self.template_name,
                           {"user_intake_percentage": 0,
                            "goal": user_info.water_amount_per_day,
                            "user_intake": 0})
-        user_intake = Intake.objects.get(user_info_id=user_info.id, date=date)
         goal = user_info.water_amount_per_day
-        intake = user_intake.total_amount
         if goal != 0:
             user_intake_percentage = int(intake / goal * 100)
             if user_intake_percentage > 100:
@@ -106,7 +107,7 @@ class ProfileView(LoginRequiredMixin, generic.DetailView):
     def get(self, request, *args, **kwargs):
         """Get all the information of authenticated user."""
         user = request.user
-        user_info = UserInfo.objects.get(user_id=user.id)
+        user_info = UserInfo.for_user(user)
         if user_info.water_amount_per_day == 0:
             return HttpResponseRedirect(reverse("aquaholic:registration", args=(user.id,)))
         date_join = user.date_joined.date()
@@ -124,7 +125,7 @@ class RegistrationView(LoginRequiredMixin, generic.DetailView):
 
     def get(self, request, *args, **kwargs):
         """Calculate page for authenticated user."""
-        user_info = UserInfo.objects.get(user_id=request.user.id)
+        user_info = UserInfo.for_user(request.user)
         if user_info.weight == 0:
             return render(request, self.template_name)
         return render(request, self.template_name,
@@ -135,26 +136,15 @@ class RegistrationView(LoginRequiredMixin, generic.DetailView):
     def post(self, request, *args, **kwargs):
         """Water amount per day calculate from user weight and exercise duration for authenticated user."""
         try:
-            user_info = UserInfo.objects.get(user_id=request.user.id)
+            user_info = UserInfo.for_user(request.user)
             user_info.weight = float(request.POST["weight"])
             user_info.exercise_duration = float(request.POST["exercise_duration"])
         except ValueError:
             message = "Please, enter numbers in both fields."
             return render(request, self.template_name,
                           {'message': message})
-        user_info.set_water_amount_per_day()
-        user_info.set_water_amount_per_hour()
-        user_info.save()
-        if user_info.water_amount_per_day == 0:
-            return render(request, 'aquaholic/regis.html',
-                          {'result': user_info.water_amount_per_day,
-                           'weight': user_info.weight,
-                           'exercise_duration': user_info.exercise_duration})
-        # update schedule
-        all_schedules = Schedule.objects.filter(user_info_id=user_info.id)
-        for one_schedule in all_schedules:
-            one_schedule.expected_amount = user_info.water_amount_per_hour
-            one_schedule.save()
+        # save the new goal and update the schedule
+        user_info.update_goal()
         return render(request, self.template_name,
                       {'result': user_info.water_amount_per_day,
                        'weight': user_info.weight,
@@ -168,7 +158,7 @@ class CalculateAuthView(LoginRequiredMixin, generic.DetailView):
 
     def get(self, request, *args, **kwargs):
         """Calculate page for authenticated user."""
-        user_info = UserInfo.objects.get(user_id=request.user.id)
+        user_info = UserInfo.for_user(request.user)
         if user_info.weight == 0:
             return render(request, self.template_name)
         return render(request, self.template_name,
@@ -179,21 +169,15 @@ class CalculateAuthView(LoginRequiredMixin, generic.DetailView):
     def post(self, request, *args, **kwargs):
         """Water amount per day calculate from user weight and exercise duration for authenticated user."""
         try:
-            user_info = UserInfo.objects.get(user_id=request.user.id)
+            user_info = UserInfo.for_user(request.user)
             user_info.weight = float(request.POST["weight"])
             user_info.exercise_duration = float(request.POST["exercise_duration"])
         except ValueError:
             message = "Please, enter numbers in both fields."
             return render(request, self.template_name,
                           {'message': message})
-        user_info.set_water_amount_per_day()
-        user_info.set_water_amount_per_hour()
-        user_info.save()
-        # update schedule
-        all_schedules = Schedule.objects.filter(user_info_id=user_info.id)
-        for one_schedule in all_schedules:
-            one_schedule.expected_amount = user_info.water_amount_per_hour
-            one_schedule.save()
+        # save the new goal and update the schedule
+        user_info.update_goal()
         return render(request, self.template_name,
                       {'result': user_info.water_amount_per_day,
                        'weight': user_info.weight,
@@ -207,12 +191,11 @@ class SetUpRegistrationView(LoginRequiredMixin, generic.DetailView):
 
     def get(self, request, *args, **kwargs):
         """Go to set up registration page for new user."""
-        user_info = UserInfo.objects.get(user_id=request.user.id)
+        user_info = UserInfo.for_user(request.user)
         if user_info.water_amount_per_day == 0:
             return HttpResponseRedirect(reverse("aquaholic:registration", args=(request.user.id,)))
-        status = check_token_status(user_info.notify_token)
         return render(request, self.template_name,
-                      {"has_token": status == 200})
+                      {"has_token": user_info.notify_token_valid})
 
 
 class SetUpView(LoginRequiredMixin, generic.DetailView):
@@ -222,17 +205,16 @@ class SetUpView(LoginRequiredMixin, generic.DetailView):
 
     def get(self, request, *args, **kwargs):
         """Set up schedule page."""
-        user_info = UserInfo.objects.get(user_id=request.user.id)
+        user_info = UserInfo.for_user(request.user)
         first = user_info.first_notification_time.strftime("%H:%M")
         last = user_info.last_notification_time.strftime("%H:%M")
         noti_hour = int(user_info.time_interval)
-        status = check_token_status(user_info.notify_token)
         if user_info.water_amount_per_day == 0:
             return HttpResponseRedirect(reverse("aquaholic:registration", args=(request.user.id,)))
         return render(request, self.template_name, {'first_notification': first,
                                                     'last_notification': last,
                                                     'notification_hour': noti_hour,
-                                                    "has_token": status == 200})
+                                                    "has_token": user_info.notify_token_valid})
 
     def post(self, request, *args, **kwargs):
         """Handle tasks after user clicked save.
@@ -242,7 +224,7 @@ class SetUpView(LoginRequiredMixin, generic.DetailView):
         the user already has notify token. User will stay on
         set up page if the value is invalid.
         """
-        user_info = UserInfo.objects.get(user_id=request.user.id)
+        user_info = UserInfo.for_user(request.user)
         try:
             first = request.POST["first_notification"]
             last = request.POST["last_notification"]
@@ -251,35 +233,36 @@ class SetUpView(LoginRequiredMixin, generic.DetailView):
             last_notify_time = datetime.datetime.strptime(last, "%H:%M").time()
         except ValueError:
             message = "Please, enter time in both fields."
-            user_info = UserInfo.objects.get(user_id=request.user.id)
-            status = check_token_status(user_info.notify_token)
+            user_info = UserInfo.for_user(request.user)
             return render(request, self.template_name,
                           {'message': message,
                            "first_notification": user_info.first_notification_time.strftime("%H:%M"),
                            "last_notification": user_info.last_notification_time.strftime("%H:%M"),
                            "notification_hour": user_info.time_interval,
-                           "has_token": status == 200})
+                           "has_token": user_info.notify_token_valid})
         if first == last or get_total_hours(first_notify_time, last_notify_time) == 0:
             message = "Please, enter different time or time difference is more than 1 hour."
             return render(request, self.template_name,
                           {'message': message})
         if user_info.water_amount_per_day == 0:
             return HttpResponseRedirect(reverse("aquaholic:registration", args=(request.user.id,)))
-        self.update_user_info(first_notify_time, last_notify_time, interval, user_info)
-        self.delete_schedule(user_info)  # remove all old schedules if any
-        self.create_schedule(user_info)  # create new schedule
-        status = check_token_status(user_info.notify_token)
+        changed = self.update_user_info(first_notify_time, last_notify_time, interval, user_info)
+        # the schedule only has to be rebuilt when the schedule rule has changed
+        if changed or not Schedule.objects.filter(user_info_id=user_info.id).exists():
+            self.regenerate_schedule(user_info)
         message = "Saved! Please, visit schedule page to see the update."
         return render(request, self.template_name,
                       {'message': message,
                        'first_notification': user_info.first_notification_time.strftime("%H:%M"),
                        'last_notification': user_info.last_notification_time.strftime("%H:%M"),
                        'notification_hour': interval,
-                       "has_token": status == 200})
+                       "has_token": user_info.notify_token_valid})
 
     @staticmethod
     def update_user_info(first_notify_time, last_notify_time, interval, user_info):
-        """Save new user information to the database."""
+        """Save new user information to the database, return False when nothing has changed."""
+        before = (user_info.first_notification_time, user_info.last_notification_time,
+                  user_info.time_interval, user_info.water_amount_per_hour)
         user_info.first_notification_time = first_notify_time
         user_info.last_notification_time = last_notify_time
         user_info.time_interval = interval
@@ -287,49 +270,39 @@ class SetUpView(LoginRequiredMixin, generic.DetailView):
         user_info.total_hours = get_total_hours(user_info.first_notification_time,
                                                 user_info.last_notification_time)
         user_info.set_water_amount_per_hour()
+        after = (user_info.first_notification_time, user_info.last_notification_time,
+                 user_info.time_interval, user_info.water_amount_per_hour)
+        if before == after:
+            return False
         user_info.save()
+        return True
 
     @staticmethod
-    def create_schedule(user_info):
-        """Create new schedule provided the new information given."""
-        # get total hours, first notification time and expected amount (water amount to drink per hour)
-        total_hours = int(user_info.total_hours)
-        expected_amount = user_info.water_amount_per_hour
-        interval = user_info.time_interval
-        last_hour = total_hours - total_hours % interval
-        first_notification_time = datetime.datetime.combine(datetime.date.today(),
-                                                            user_info.first_notification_time)
-        last_notification_time = first_notification_time + datetime.timedelta(hours=last_hour)
-        # last notification time less than now, the schedule will notify tomorrow
-        if last_notification_time < datetime.datetime.now():
-            first_notification_time += datetime.timedelta(hours=24)
-        notification_time = first_notification_time
-        if user_info.notification_turned_on:
-            for i in range(0, total_hours + 1, interval):
-                Schedule.objects.create(user_info_id=user_info.id,
-                                        notification_time=make_aware(notification_time),
-                                        expected_amount=expected_amount,
-                                        notification_status=(notification_time < datetime.datetime.now()),
-                                        is_last=(i == last_hour)
-                                        )
-                notification_time += datetime.timedelta(hours=interval)
-        else:
-            for i in range(0, total_hours + 1, interval):
-                Schedule.objects.create(user_info_id=user_info.id,
-                                        notification_time=make_aware(notification_time),
-                                        expected_amount=expected_amount,
-                                        notification_status=True,
-                                        is_last=(i == last_hour)
-                                        )
-                notification_time += datetime.timedelta(hours=interval)
+    def create_schedule(user_info, now=None):
+        """Create new schedule provided the new information given, in one bulk INSERT."""
+        # notification times come from the user's schedule rule, past ones are already done
+        now = now or timezone.now()
+        notification_times = user_info.notification_times(now)
+        Schedule.objects.bulk_create([
+            Schedule(user_info_id=user_info.id,
+                     notification_time=notification_time,
+                     expected_amount=user_info.water_amount_per_hour,
+                     notification_status=(not user_info.notification_turned_on or notification_time < now),
+                     is_last=(i == len(notification_times) - 1))
+            for i, notification_time in enumerate(notification_times)
+        ])
 
     @staticmethod
     def delete_schedule(user_info):
         """Delete all the existing schedule for this user."""
-        if Schedule.objects.filter(user_info_id=user_info.id).exists():
-            found_schedule = Schedule.objects.filter(user_info_id=user_info.id)
-            for one_schedule in found_schedule:
-                one_schedule.delete()
+        Schedule.objects.filter(user_info_id=user_info.id).delete()
+
+    @classmethod
+    def regenerate_schedule(cls, user_info, now=None):
+        """Replace the user's schedule in one transaction, so the dispatcher never sees half of it."""
+        with transaction.atomic():
+            cls.delete_schedule(user_info)
+            cls.create_schedule(user_info, now)
 
 
 class LineNotifyVerificationView(LoginRequiredMixin, generic.DetailView):
@@ -347,12 +320,11 @@ class LineNotifyConnect(LoginRequiredMixin, generic.DetailView):
 
     def get(self, request, *args, **kwargs):
         """Go to line connect page."""
-        user_info = UserInfo.objects.get(user_id=request.user.id)
+        user_info = UserInfo.for_user(request.user)
         if user_info.water_amount_per_day == 0:
             return HttpResponseRedirect(reverse("aquaholic:registration", args=(request.user.id,)))
-        status = check_token_status(user_info.notify_token)
         return render(request, "aquaholic/line_connect.html",
-                      {"has_token": status == 200})
+                      {"has_token": user_info.notify_token_valid})
 
 
 class NotificationCallbackView(LoginRequiredMixin, generic.DetailView):
@@ -362,9 +334,17 @@ class NotificationCallbackView(LoginRequiredMixin, generic.DetailView):
         """Send welcome message to new user and save generated token to user info."""
         code = request.GET['code']
         token = get_access_token(code)
-        send_notification("Welcome to aquaholic", token)
-        user_info = UserInfo.objects.get(user_id=request.user.id)
+        if not token:
+            # LINE issued no token, the user stays unconnected
+            return HttpResponseRedirect(reverse('aquaholic:line_connect', args=(request.user.id,)))
+        status = send_notification("Welcome to aquaholic", token)
+        user_info = UserInfo.for_user(request.user)
         user_info.notify_token = token
+        # only a delivered welcome message proves the token works, when LINE
+        # could not tell the token is left unchecked for the token sweep
+        user_info.notify_token_valid = status == 200
+        user_info.notify_token_checked_time = timezone.now() if status in (200, 401) else None
+        user_info.notify_auth_failures = 0
         user_info.save()
         return HttpResponseRedirect(reverse('aquaholic:line_connect', args=(request.user.id,)))
 
@@ -377,37 +357,23 @@ class ScheduleView(LoginRequiredMixin, generic.DetailView):
 
     def get(self, request, *args, **kwargs):
         """Illustrated the schedule for user."""
-        user_info = UserInfo.objects.get(user_id=request.user.id)
+        user_info = UserInfo.for_user(request.user)
         if user_info.water_amount_per_day == 0:
             return HttpResponseRedirect(reverse("aquaholic:registration", args=(request.user.id,)))
-        status = check_token_status(user_info.notify_token)
         return render(request, self.template_name,
-                      {'schedule': Schedule.objects.filter(user_info_id=user_info.id),
-                       'has_token': status == 200})
+                      {'schedule': user_info.reminders(),
+                       'has_token': user_info.notify_token_valid})
 
     def post(self, request, *args, **kwargs):
         """Notification of schedule."""
         status = request.POST['status']
-        user_info = UserInfo.objects.get(user_id=request.user.id)
-        user_schedule = Schedule.objects.filter(user_info_id=user_info.id)
+        user_info = UserInfo.for_user(request.user)
         if user_info.water_amount_per_day == 0:
             return HttpResponseRedirect(reverse("aquaholic:registration", args=(request.user.id,)))
-        if status == "turn_off":
-            user_info.notification_turned_on = False
-            user_info.save()
-            for row in user_schedule:
-                row.notification_status = True
-                row.save()
-        else:
-            user_info.notification_turned_on = True
-            user_info.save()
-            for row in user_schedule:
-                row.notification_status = row.notification_time < timezone.now()
-                row.save()
-        status = check_token_status(user_info.notify_token)
+        user_info.set_notification_turned_on(status != "turn_off", timezone.now())
         return render(request, self.template_name,
-                      {'schedule': Schedule.objects.filter(user_info_id=user_info.id),
-                       'has_token': status == 200})
+                      {'schedule': user_info.reminders(),
+                       'has_token': user_info.notify_token_valid})
 
 
 class InputView(LoginRequiredMixin, generic.DetailView):
@@ -418,7 +384,7 @@ class InputView(LoginRequiredMixin, generic.DetailView):
 
     def get(self, request, *args, **kwargs):
         """Input schedule page."""
-        user_info = UserInfo.objects.get(user_id=request.user.id)
+        user_info = UserInfo.for_user(request.user)
         if user_info.water_amount_per_day == 0:
             return HttpResponseRedirect(reverse("aquaholic:registration", args=(request.user.id,)))
         return render(request, self.template_name)
@@ -437,18 +403,11 @@ class InputView(LoginRequiredMixin, generic.DetailView):
                           {'message': message})
         # default time for intake date is 10 am
         aware_date = make_aware(intake_date)
-        user_info = UserInfo.objects.get(user_id=request.user.id)
+        user_info = UserInfo.for_user(request.user)
         if user_info.water_amount_per_day == 0:
             return HttpResponseRedirect(reverse("aquaholic:registration", args=(request.user.id,)))
-        # User already have intake for the given day, add amount of water to existed amount
-        if Intake.objects.filter(user_info_id=user_info.id, date=aware_date).exists():
-            intake = Intake.objects.get(user_info_id=user_info.id, date=aware_date)
-            intake.total_amount += amount
-            intake.save()
-        else:
-            Intake.objects.create(user_info_id=user_info.id,
-                                  date=aware_date,
-                                  total_amount=amount)
+        # add amount of water to the intake of the given day
+        Intake.add(user_info.id, aware_date, amount)
         if amount <= 0:
             message = "Sorry! Water amount must be a positive number more than 0."
         else:
@@ -471,7 +430,7 @@ class HistoryView(LoginRequiredMixin, generic.DetailView):
         for day in range(1, num_days_in_month + 1):
             reached_goal_amount[datetime.date(selected_year, selected_month, day).strftime("%d %b %Y")] = 0
             not_reached_goal_amount[datetime.date(selected_year, selected_month, day).strftime("%d %b %Y")] = 0
-        user_info = UserInfo.objects.get(user_id=request.user.id)
+        user_info = UserInfo.for_user(request.user)
         if user_info.water_amount_per_day == 0:
             return HttpResponseRedirect(reverse("aquaholic:registration", args=(request.user.id,)))
         goal = user_info.water_amount_per_day
@@ -519,32 +478,25 @@ class HistoryView(LoginRequiredMixin, generic.DetailView):
 def update_notification(request):
     """Cron job for sending notification via line.
 
-    Send notification to the user and update their status.
     Cron-job.org will call this view every 5 minutes to check
-    if it's the time to send notification. After the last notification
-    in a user's schedule is sent, the time in the schedule will be
-    added by 24 hours.
+    if it's the time to send notification. The tick is handed to a
+    background thread (see aquaholic.cron.start_tick) and the view answers
+    202 at once with the tick id and the url of its status.
     """
-    all_to_send = Schedule.objects.filter(notification_time__lte=timezone.now(),
-                                          notification_status=False)
-    for one_to_send in all_to_send:
-        send_notification(f"Don't forget to drink {one_to_send.expected_amount} ml of water",
-                          one_to_send.user_info.notify_token)
-        one_to_send.notification_status = True
-        one_to_send.save()
-
-    last_to_send = Schedule.objects.filter(notification_status=True, is_last=True,
-                                           notification_time__lte=timezone.now())
-    for last_schedule in last_to_send:
-        user_info = last_schedule.user_info
-        user_schedule = Schedule.objects.filter(user_info=user_info)
-        if user_info.notification_turned_on:
-            for schedule in user_schedule:
-                schedule.notification_time += timezone.timedelta(hours=24)
-                schedule.notification_status = False
-                schedule.save()
-        else:
-            for schedule in user_schedule:
-                schedule.notification_time += timezone.timedelta(hours=24)
-                schedule.save()
-    return HttpResponse()
+    tick = cron.start_tick()
+    return JsonResponse({'tick': tick.id, 'status': tick.status,
+                         'status_url': reverse('aquaholic:cron_status', args=(tick.id,))},
+                        status=HTTPStatus.ACCEPTED)
+
+
+def tick_status(request, pk):
+    """Show the progress of a notification tick."""
+    tick = get_object_or_404(DispatcherTick, pk=pk)
+    return JsonResponse({'tick': tick.id, 'status': tick.status, 'started_time': tick.started_time,
+                         'finished_time': tick.finished_time, 'due': tick.due, 'sent': tick.sent,
+                         'failed': tick.failed, 'skipped': tick.skipped, 'backlog': tick.backlog})
+
+
+def dispatcher_metrics(request):
+    """Show the statistics of the latest notification tick as plain text metrics."""
+    return HttpResponse(metrics.render_metrics(), content_type='text/plain; version=0.0.4')
@@ -149,4 +149,55 @@ SOCIALACCOUNT_PROVIDERS = {
 
 CRONJOBS = [
     ('*/1 * * * *', 'aquaholic.cron.update_notification'),
+    ('15 */6 * * *', 'django.core.management.call_command', ['check_notify_tokens']),
 ]
+
+# Number of threads used to send LINE notifications concurrently in one tick
+NOTIFICATION_WORKERS = config('NOTIFICATION_WORKERS', cast=int, default=8)
+
+# Base urls of the LINE Notify APIs, point them at aquaholic.line_emulator to run without LINE
+LINE_NOTIFY_API_URL = config('LINE_NOTIFY_API_URL', default='https://notify-api.line.me')
+LINE_NOTIFY_BOT_URL = config('LINE_NOTIFY_BOT_URL', default='https://notify-bot.line.me')
+
+# HTTP client used for the LINE APIs (seconds, see aquaholic.notification.LineClient)
+LINE_CONNECT_TIMEOUT = config('LINE_CONNECT_TIMEOUT', cast=float, default=3.05)
+LINE_READ_TIMEOUT = config('LINE_READ_TIMEOUT', cast=float, default=10)
+LINE_RETRIES = config('LINE_RETRIES', cast=int, default=2)
+LINE_RETRY_BACKOFF = config('LINE_RETRY_BACKOFF', cast=float, default=0.5)
+LINE_BREAKER_THRESHOLD = config('LINE_BREAKER_THRESHOLD', cast=int, default=5)
+LINE_BREAKER_RESET = config('LINE_BREAKER_RESET', cast=float, default=30)
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler'},
+    },
+    'loggers': {
+        'aquaholic': {
+            'handlers': ['console'],
+            'level': config('AQUAHOLIC_LOG_LEVEL', default='INFO'),
+        },
+    },
+}
+
+# Adaptive throttle for LINE notify sends (see aquaholic.throttle.SendThrottle)
+NOTIFICATION_MAX_RATE = config('NOTIFICATION_MAX_RATE', cast=float, default=50)
+NOTIFICATION_BURST = config('NOTIFICATION_BURST', cast=int, default=50)
+NOTIFICATION_THROTTLE_WAIT = config('NOTIFICATION_THROTTLE_WAIT', cast=float, default=1)
+
+# Durable notification outbox (see aquaholic.outbox)
+NOTIFICATION_BATCH_SIZE = config('NOTIFICATION_BATCH_SIZE', cast=int, default=500)
+NOTIFICATION_MAX_ATTEMPTS = config('NOTIFICATION_MAX_ATTEMPTS', cast=int, default=5)
+# seconds before the first retry, doubled after every further failure
+NOTIFICATION_RETRY_DELAY = config('NOTIFICATION_RETRY_DELAY', cast=int, default=60)
+# days a sent message is kept in the outbox
+NOTIFICATION_OUTBOX_RETENTION = config('NOTIFICATION_OUTBOX_RETENTION', cast=int, default=7)
+# seconds a dispatcher worker holds the messages it claimed, after that another worker may take them
+NOTIFICATION_LEASE_SECONDS = config('NOTIFICATION_LEASE_SECONDS', cast=int, default=300)
+# seconds one tick may spend sending, whatever is left waits for the next tick
+NOTIFICATION_TICK_BUDGET = config('NOTIFICATION_TICK_BUDGET', cast=int, default=50)
+# 401 answers in a row after which a LINE token is treated as revoked
+NOTIFICATION_AUTH_FAILURE_LIMIT = config('NOTIFICATION_AUTH_FAILURE_LIMIT', cast=int, default=3)
+# seconds after which an overdue reminder is dropped instead of sent, 0 sends every overdue reminder
+NOTIFICATION_STALE_AFTER = config('NOTIFICATION_STALE_AFTER', cast=int, default=0)